@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #=======================================================================
 # huffman.py
@@ -15,119 +15,66 @@
 #-------------------------------------------------------------------
 # Imports.
 #-------------------------------------------------------------------
+import os
+import time
 import argparse
 import random
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from prefix_tuple_tree import gen_file_histogram
+from prefix_tuple_tree import extract_prefix_codes, gen_prefix_tree
+from prefix_tuple_tree import sort_node_list
+from prefix_tuple_tree import gen_histogram, load_file, save_file
+from prefix_tuple_tree import gen_canonical_codes
+from prefix_tuple_tree import bitencode_chunk, flush_bits
+from prefix_tuple_tree import gen_decode_tables, decode_chunk
+from prefix_tuple_tree import NUM_SYMBOLS, CHUNK_SIZE
+from prefix_tuple_tree import get_metrics_sink, set_metrics_sink
+from prefix_tuple_tree import emit_metrics, print_metrics
+from prefix_tuple_tree import CodeTableCache, Encoder, Decoder
+from prefix_tuple_tree import pack_code_lengths, unpack_code_lengths
+from prefix_tuple_tree import encode_streams, decode_streams
+from prefix_tuple_tree import NUM_STREAMS, MAX_STREAMS
+from prefix_tuple_tree import NUMPY_MIN_LANES, NUMPY_MAX_LANE_BITS
 
 
 #-------------------------------------------------------------------
 # Constants.
 #-------------------------------------------------------------------
-VERBOSE = True
-DEBUG = True
+VERBOSE = False
 
 VERSION = '0.1 Beta'
 
+FILE_MAGIC = b'HUFF'
+FILE_VERSION = 2
 
-#-------------------------------------------------------------------
-# get_node_codes()
-#
-# Get a list of tuples with the prefix codes for a char in a
-# given node as well as for its subnodes.
-#-------------------------------------------------------------------
-def get_node_codes(prefix, ptree):
-    (char, weight, children, left_tree, right_tree) = ptree
-
-    if char == None:
-        left_list = []
-        right_list = []
-
-        if left_tree != None:
-          left_list = get_node_codes(prefix + '0', left_tree)
-
-        if right_tree != None:
-          right_list = get_node_codes(prefix + '1', right_tree)
-
-        return left_list + right_list
-
-    else:
-        return [(char, weight, prefix)]
-
-
-#-------------------------------------------------------------------
-# extract_prefix_codes()
-#
-# Given a prefix tree, extracts the prefix codes for all
-# leaves. The prefix codes are returned as a dictionary.
-#-------------------------------------------------------------------
-def extract_prefix_codes(ptree):
-    (char, weight, children, left_tree, right_tree) = ptree
-
-    left_list = get_node_codes('0', left_tree)
-    right_list = get_node_codes('1', right_tree)
-
-    prefix_dict = {}
-
-    for (char, weight, prefix) in left_list:
-        prefix_dict[char] = (weight, prefix)
+BLOCK_FILE_MAGIC = b'HUFB'
+BLOCK_FILE_VERSION = 3
+BLOCK_SIZE = 1 << 20
+SYNC_INTERVAL = 1 << 18
 
-    for (char, weight, prefix) in right_list:
-        prefix_dict[char] = (weight, prefix)
+# Upper bound of the size of 256 code lengths packed with
+# pack_code_lengths().
+MAX_TABLE_SIZE = 512
 
-    return prefix_dict
-
-
-#-------------------------------------------------------------------
-# gen_prefix_tree()
-#
-# Given a list of tuples with frequency (weight) for a character
-# the function returns the corresponding tuple based prefix tree.
-#-------------------------------------------------------------------
-def gen_prefix_tree(nlist):
-    while (len(nlist) > 1):
-        if VERBOSE:
-            print("Length of prefix list: %d" % len(nlist))
-
-        nlist = sort_node_list(nlist)
-        node1 = nlist.pop()
-        node2 = nlist.pop()
-
-        if VERBOSE:
-            print("node1 weigth: %d" % node1[1])
-            print("node2 weigth: %d" % node2[1])
-
-        new_weight = node1[1] + node2[1]
-        new_children = 2 + node1[2] + node2[2]
-        new_node = (None, new_weight, new_children, node1, node2)
-        nlist.append(new_node)
-
-    return nlist.pop()
-
-
-#-------------------------------------------------------------------
-# sort_node_list()
-#
-# Given a list of nodes returns a list with the nodes
-# sorted by weight in decreasing order.
-#-------------------------------------------------------------------
-def sort_node_list(nlist):
-    tmp_nlist = nlist[:]
-    nodes = 0
-    new_list = []
-    if VERBOSE:
-        print("Length of given list: %d" % len(tmp_nlist))
-    for i in range(len(tmp_nlist)):
-        node = tmp_nlist.pop()
-        nodes += 1
-        if len(new_list) == 0:
-            new_list.append(node)
-        else:
-            i = 0
-            while ((i < len(new_list) and (node[1] < new_list[i][1]))):
-                i += 1
-            new_list = new_list[:i] + [node] + new_list[i:]
+# Code tables reused across files and blocks with similar
+# statistics. Each worker process in block mode has its own. The
+# code lengths are limited to MAX_CODE_LENGTH bits to bound the
+# cost of the decode tables and of the bit accumulator.
+MAX_CODE_LENGTH = 24
+CODE_TABLE_CACHE = CodeTableCache(max_code_length=MAX_CODE_LENGTH)
 
-    return new_list
+# Multi stream files are split into STREAM_BLOCK_SIZE blocks, each
+# encoded as num_streams sub-streams with encode_streams(). The
+# code lengths are limited so that the NumPy lane decoder can be
+# used.
+STREAM_FILE_MAGIC = b'HUFM'
+STREAM_FILE_VERSION = 1
+STREAM_BLOCK_SIZE = 1 << 20
+STREAM_HEADER_SIZE = 10
+STREAM_TABLE_CACHE = CodeTableCache(max_code_length=NUMPY_MAX_LANE_BITS)
 
 
 #-------------------------------------------------------------------
@@ -184,64 +131,503 @@ def print_prefix_codes(prefix_codes):
 #-------------------------------------------------------------------
 # huffman_encode()
 #
-# Huffman encode a file with a given filename.
+# Huffman encode a file with a given filename and write the
+# encoded data to the file outfilename.
 # Note: We assume that the file contains bytes.
+#
+# The file is read twice, chunk_size bytes at a time, so the
+# memory used does not depend on the size of the file.
 #-------------------------------------------------------------------
-def huffman_encode(filename):
+def huffman_encode(filename, outfilename, chunk_size = CHUNK_SIZE):
     '''Encode the contents of the file using Huffman coding.'''
 
+    sink = get_metrics_sink()
+    if sink != None:
+        start_time = time.perf_counter()
+
     # 1. First pass. Scan the file and build byte
     # frequency statistics.
-    byte_freq = [0] * 256
-    with open(filename, 'rb') as my_file:
-        byte = my_file.read(1)
-        bytectr = 1
-        while byte:
-            byteval = ord(byte)
-            byte_freq[byteval] = byte_freq[byteval] + 1
-            byte = my_file.read(1)
-            bytectr = bytectr + 1
-
-    if DEBUG:
-        print "Encode step one."
-        print "Number of bytes read: %d" % bytectr
-        print byte_freq
-        print ""
-
+    byte_freq = gen_file_histogram(filename, chunk_size)
 
     # 2. Build weighted binary tree for all bytes in the file.
-    alphabet = []
-    for i in range(256):
-        if (byte_freq[i] > 0):
-            alphabet.append([i, byte_freq[i], 0, 0, 0])
+    # 3. Create symbol table based on the tree.
+    # A cached table is reused instead if it is good enough.
+    if sum(byte_freq):
+        (code_table, len_table) = CODE_TABLE_CACHE.get_codes(byte_freq)
+    else:
+        (code_table, len_table) = ([0] * NUM_SYMBOLS, [0] * NUM_SYMBOLS)
+
+    with open(outfilename, 'wb') as out_file:
+        # 4. Emit symbol table as header for file.
+        write_header(out_file, sum(byte_freq), len_table)
+
+        # 5. Second pass. Read file and emit symbols.
+        encoder = Encoder(len_table)
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        with open(filename, 'rb') as in_file:
+            num_read = in_file.readinto(buf)
+            while num_read:
+                out_file.write(encoder.feed(view[:num_read]))
+                num_read = in_file.readinto(buf)
+        out_file.write(encoder.flush())
+
+        if sink != None:
+            emit_metrics(sink, 'file_encode', start_time,
+                         bytes_in=sum(byte_freq), bytes_out=out_file.tell())
 
-    if DEBUG:
-        print "Number of symbols in the alphabet: %d" % len(alphabet)
-        print "The collected alphabet with weighs:"
-        print alphabet
+    # 6. Done!
+    return 0
 
-    elements_left = len(alphabet)
-    while elements_left:
-        pass
-        # Find the two elements with the least weight
 
-    # 3. Create symbol table based on the tree
+#-------------------------------------------------------------------
+# huffman_decode()
+#
+# Huffman decode a file with the given filename and write the
+# decoded data to the file outfilename. The encoded file is
+# read and decoded chunk_size bytes at a time.
+#-------------------------------------------------------------------
+def huffman_decode(filename, outfilename, chunk_size = CHUNK_SIZE):
+    sink = get_metrics_sink()
+    if sink != None:
+        start_time = time.perf_counter()
+
+    with open(filename, 'rb') as in_file:
+        (num_chars, len_table) = read_header(in_file)
+        decoder = Decoder(len_table, num_chars)
+
+        with open(outfilename, 'wb') as out_file:
+            buf = bytearray(chunk_size)
+            view = memoryview(buf)
+            while not decoder.eof:
+                num_read = in_file.readinto(buf)
+                if not num_read:
+                    raise ValueError("Encoded file ended before %d chars were decoded."
+                                     % num_chars)
+                out_file.write(decoder.feed(view[:num_read]))
+
+        if sink != None:
+            emit_metrics(sink, 'file_decode', start_time,
+                         bytes_in=in_file.tell(), bytes_out=num_chars)
 
-    # 4. Emit symbol table as header for file.
+    return 0
 
-    # 5. Second pass. Read file and emit symbols.
 
-    # 6. Done!
+#-------------------------------------------------------------------
+# write_header()
+#
+# Write the file header with the number of encoded chars and the
+# code lengths for all chars, packed with pack_code_lengths().
+# The canonical codes are rebuilt from the lengths when decoding.
+#-------------------------------------------------------------------
+def write_header(out_file, num_chars, len_table):
+    out_file.write(FILE_MAGIC)
+    out_file.write(bytes([FILE_VERSION]))
+    out_file.write(num_chars.to_bytes(8, 'big'))
+    out_file.write(pack_code_lengths(len_table))
+
+
+#-------------------------------------------------------------------
+# read_header()
+#
+# Read a file header written by write_header(). Returns a tuple
+# (num_chars, len_table), with the file positioned at the first
+# encoded byte.
+#-------------------------------------------------------------------
+def read_header(in_file):
+    start = in_file.tell()
+    header = in_file.read(len(FILE_MAGIC) + 1 + 8 + MAX_TABLE_SIZE)
+    if len(header) < len(FILE_MAGIC) + 1 + 8 or\
+       header[0 : len(FILE_MAGIC)] != FILE_MAGIC:
+        raise ValueError("Not a Huffman encoded file.")
+
+    pos = len(FILE_MAGIC)
+    if header[pos] != FILE_VERSION:
+        raise ValueError("Unsupported file version %d." % header[pos])
+
+    num_chars = int.from_bytes(header[pos + 1 : pos + 9], 'big')
+    (len_table, pos) = unpack_code_lengths(header, NUM_SYMBOLS, pos + 9)
+    in_file.seek(start + pos)
+    return (num_chars, len_table)
+
+
+#-------------------------------------------------------------------
+# encode_block()
+#
+# Huffman encode a single block of bytes with its own prefix
+# tree built from the histogram of the block, or with a cached
+# table built for a block with similar statistics. Returns a
+# tuple (len_table, enc_bytes, sync_offsets) with the packed code
+# lengths for the block, the encoded block and the bit offsets in
+# the encoded block where chars sync_interval, 2 * sync_interval,
+# ... start.
+# Run in the worker processes by huffman_encode_blocks().
+#-------------------------------------------------------------------
+def encode_block(block, sync_interval = SYNC_INTERVAL):
+    if not block:
+        return (pack_code_lengths([0] * NUM_SYMBOLS), b'', [])
+
+    (code_table, len_table) = CODE_TABLE_CACHE.get_codes(gen_histogram(block))
+
+    enc_bytes = bytearray()
+    sync_offsets = []
+    acc = 0
+    acc_bits = 0
+    for start in range(0, len(block), sync_interval):
+        if start:
+            sync_offsets.append(len(enc_bytes) * 8 + acc_bits)
+        (chunk, acc, acc_bits) = bitencode_chunk(block[start : start + sync_interval],
+                                                 code_table, len_table,
+                                                 acc, acc_bits)
+        enc_bytes += chunk
+    enc_bytes += flush_bits(acc, acc_bits)
+
+    return (pack_code_lengths(len_table), bytes(enc_bytes), sync_offsets)
+
+
+#-------------------------------------------------------------------
+# decode_segment()
+#
+# Decode num_chars chars starting at the given bit offset in the
+# encoded data of a block with the given packed code lengths.
+# Run in the worker processes by huffman_decode_blocks().
+#-------------------------------------------------------------------
+def decode_segment(len_table, enc_bytes, bit_offset, num_chars):
+    (len_table, pos) = unpack_code_lengths(len_table, NUM_SYMBOLS)
+    code_table = gen_canonical_codes(len_table)
+    decode_tables = gen_decode_tables(code_table, len_table)
+
+    pos = bit_offset >> 3
+    acc_bits = -bit_offset % 8
+    acc = 0
+    if acc_bits:
+        acc = enc_bytes[pos] & ((1 << acc_bits) - 1)
+        pos += 1
+
+    (dec_bytes, acc, acc_bits) = decode_chunk(memoryview(enc_bytes)[pos:],
+                                              decode_tables, num_chars,
+                                              acc, acc_bits)
+    if len(dec_bytes) < num_chars:
+        raise ValueError("Encoded block ended before %d chars were decoded."
+                         % num_chars)
+    return bytes(dec_bytes)
+
+
+#-------------------------------------------------------------------
+# gen_block_segments()
+#
+# Given a block index and the sync interval returns a list of
+# all segments that can be decoded independently. Each segment
+# is a tuple (offset, table_end, enc_start, enc_end, bit_offset,
+# num_chars, char_start) where offset and table_end give the
+# file offsets of the packed code lengths for the block,
+# enc_start and enc_end give the file offsets of the encoded
+# bytes needed, bit_offset is the bit offset of the first code in
+# those bytes, and char_start is the offset of the first char in
+# the decoded data.
+#-------------------------------------------------------------------
+def gen_block_segments(block_index, sync_interval):
+    segments = []
+    char_start = 0
+    for (offset, table_size, size, num_chars, sync_offsets) in block_index:
+        enc_offset = offset + table_size
+        bit_starts = [0] + sync_offsets
+        bit_ends = sync_offsets + [size * 8]
+        for i in range(len(bit_starts)):
+            byte_start = bit_starts[i] >> 3
+            byte_end = (bit_ends[i] + 7) >> 3
+            seg_chars = min(sync_interval, num_chars - i * sync_interval)
+            segments.append((offset, enc_offset, enc_offset + byte_start,
+                             enc_offset + byte_end,
+                             bit_starts[i] - byte_start * 8,
+                             seg_chars, char_start + i * sync_interval))
+        char_start += num_chars
+    return segments
+
+
+#-------------------------------------------------------------------
+# huffman_encode_blocks()
+#
+# Huffman encode the file with the given filename as independent
+# blocks of block_size bytes and write them to the file
+# outfilename. Each block gets its own prefix tree and codes.
+# The blocks are encoded in parallel by a pool of worker
+# processes (default one per CPU). At most two blocks per worker
+# are in flight, and blocks are written in order as they are
+# done. The bit offset of every sync_interval:th char in each
+# block is recorded in the block index to allow the blocks to be
+# decoded in parallel segments and from any char position.
+#
+# The file is a block container:
+#   magic, version, block_size (4 bytes), sync_interval (4 bytes)
+#   for each block: packed code lengths, encoded data
+#   block index: num_blocks (4 bytes) followed by
+#                offset (8 bytes), code lengths size (2 bytes),
+#                size (4 bytes),
+#                num_chars (4 bytes), num_sync (4 bytes),
+#                num_sync sync bit offsets (8 bytes each)
+#                for each block
+#   offset of the block index (8 bytes)
+#-------------------------------------------------------------------
+def huffman_encode_blocks(filename, outfilename, block_size = BLOCK_SIZE,
+                          workers = None, sync_interval = SYNC_INTERVAL):
+    if workers == None:
+        workers = os.cpu_count() or 1
+
+    data = load_file(filename)
+    block_index = []
+
+    with open(outfilename, 'wb') as out_file:
+        out_file.write(BLOCK_FILE_MAGIC)
+        out_file.write(bytes([BLOCK_FILE_VERSION]))
+        out_file.write(block_size.to_bytes(4, 'big'))
+        out_file.write(sync_interval.to_bytes(4, 'big'))
+
+        def write_block(start, future):
+            (len_table, enc_bytes, sync_offsets) = future.result()
+            block_index.append((out_file.tell(), len(len_table), len(enc_bytes),
+                                min(block_size, len(data) - start),
+                                sync_offsets))
+            out_file.write(len_table)
+            out_file.write(enc_bytes)
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for start in range(0, len(data), block_size):
+                block = bytes(data[start : start + block_size])
+                pending.append((start, executor.submit(encode_block, block,
+                                                       sync_interval)))
+                if len(pending) >= 2 * workers:
+                    write_block(*pending.popleft())
+
+            while pending:
+                write_block(*pending.popleft())
+
+        write_block_index(out_file, block_index)
+
     return 0
 
 
 #-------------------------------------------------------------------
-# huffman_decode()
+# huffman_decode_blocks()
+#
+# Decode a block container written by huffman_encode_blocks()
+# and write the decoded data to the file outfilename. The
+# segments between sync points are decoded in parallel by a
+# pool of worker processes (default one per CPU) and written in
+# order. At most two segments per worker are in flight.
+#-------------------------------------------------------------------
+def huffman_decode_blocks(filename, outfilename, workers = None):
+    if workers == None:
+        workers = os.cpu_count() or 1
+
+    data = load_file(filename)
+    (block_size, sync_interval, block_index) = read_block_index(data)
+
+    with open(outfilename, 'wb') as out_file:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for (offset, table_end, enc_start, enc_end, bit_offset, num_chars,
+                 char_start) in gen_block_segments(block_index, sync_interval):
+                pending.append(executor.submit(decode_segment,
+                                               bytes(data[offset : table_end]),
+                                               bytes(data[enc_start : enc_end]),
+                                               bit_offset, num_chars))
+                if len(pending) >= 2 * workers:
+                    out_file.write(pending.popleft().result())
+
+            while pending:
+                out_file.write(pending.popleft().result())
+
+    return 0
+
+
+#-------------------------------------------------------------------
+# huffman_decode_range()
 #
-# Huffman decode a file with the given filename.
+# Decode length bytes starting at byte offset start of the
+# original data from a block container written by
+# huffman_encode_blocks(). Only the segments covering the range
+# are decoded, starting at the closest sync point before start.
+# Returns the decoded bytes. Raises ValueError if start or length
+# is negative.
 #-------------------------------------------------------------------
-def huffman_decode(filename):
-    pass
+def huffman_decode_range(filename, start, length):
+    if start < 0 or length < 0:
+        raise ValueError("Invalid range with offset %d and length %d." %\
+                         (start, length))
+
+    data = load_file(filename)
+    (block_size, sync_interval, block_index) = read_block_index(data)
+
+    end = start + length
+    dec_bytes = bytearray()
+    for (offset, table_end, enc_start, enc_end, bit_offset, num_chars,
+         char_start) in gen_block_segments(block_index, sync_interval):
+        if char_start + num_chars <= start:
+            continue
+        if char_start >= end:
+            break
+
+        seg_bytes = decode_segment(data[offset : table_end],
+                                   data[enc_start : enc_end], bit_offset,
+                                   min(num_chars, end - char_start))
+        dec_bytes += seg_bytes[max(0, start - char_start) :]
+
+    return bytes(dec_bytes)
+
+
+#-------------------------------------------------------------------
+# write_block_index()
+#
+# Write the block index and the offset to it at the end of a
+# block container.
+#-------------------------------------------------------------------
+def write_block_index(out_file, block_index):
+    index_offset = out_file.tell()
+    out_file.write(len(block_index).to_bytes(4, 'big'))
+    for (offset, table_size, size, num_chars, sync_offsets) in block_index:
+        out_file.write(offset.to_bytes(8, 'big'))
+        out_file.write(table_size.to_bytes(2, 'big'))
+        out_file.write(size.to_bytes(4, 'big'))
+        out_file.write(num_chars.to_bytes(4, 'big'))
+        out_file.write(len(sync_offsets).to_bytes(4, 'big'))
+        for sync_offset in sync_offsets:
+            out_file.write(sync_offset.to_bytes(8, 'big'))
+    out_file.write(index_offset.to_bytes(8, 'big'))
+
+
+#-------------------------------------------------------------------
+# read_block_index()
+#
+# Read the header and block index from the given block container
+# data. Returns a tuple (block_size, sync_interval, block_index)
+# where the block index is a list of (offset, table_size, size,
+# num_chars, sync_offsets) tuples.
+#-------------------------------------------------------------------
+def read_block_index(data):
+    pos = len(BLOCK_FILE_MAGIC)
+    if len(data) < pos + 9 + 4 + 8 or data[0 : pos] != BLOCK_FILE_MAGIC:
+        raise ValueError("Not a Huffman block container.")
+    if data[pos] != BLOCK_FILE_VERSION:
+        raise ValueError("Unsupported block container version %d." % data[pos])
+    block_size = int.from_bytes(data[pos + 1 : pos + 5], 'big')
+    sync_interval = int.from_bytes(data[pos + 5 : pos + 9], 'big')
+
+    index_offset = int.from_bytes(data[len(data) - 8 :], 'big')
+    num_blocks = int.from_bytes(data[index_offset : index_offset + 4], 'big')
+    block_index = []
+    pos = index_offset + 4
+    for i in range(num_blocks):
+        num_sync = int.from_bytes(data[pos + 18 : pos + 22], 'big')
+        sync_offsets = [int.from_bytes(data[pos + 22 + j * 8 : pos + 30 + j * 8], 'big')
+                        for j in range(num_sync)]
+        block_index.append((int.from_bytes(data[pos : pos + 8], 'big'),
+                            int.from_bytes(data[pos + 8 : pos + 10], 'big'),
+                            int.from_bytes(data[pos + 10 : pos + 14], 'big'),
+                            int.from_bytes(data[pos + 14 : pos + 18], 'big'),
+                            sync_offsets))
+        pos += 22 + num_sync * 8
+
+    return (block_size, sync_interval, block_index)
+
+
+#-------------------------------------------------------------------
+# huffman_encode_streams()
+#
+# Huffman encode a file with the given filename into the multi
+# stream format and write it to the file outfilename. The file is
+# read and encoded block_size bytes at a time. Each block gets its
+# own code table and is split into num_streams interleaved
+# sub-streams with a jump table by encode_streams(), so that the
+# decoder can decode all sub-streams of a block in lockstep.
+#
+# The file format is:
+#   magic, version, num_streams (1 byte)
+#   for each block: num_chars (4 bytes), code lengths size
+#                   (2 bytes), encoded size (4 bytes), packed
+#                   code lengths, jump table and sub-streams
+#   a block header with zero chars ending the file
+#-------------------------------------------------------------------
+def huffman_encode_streams(filename, outfilename, num_streams = NUM_STREAMS,
+                           block_size = STREAM_BLOCK_SIZE):
+    if not 1 <= num_streams <= MAX_STREAMS:
+        raise ValueError("Number of streams must be 1 to %d." % MAX_STREAMS)
+
+    sink = get_metrics_sink()
+    if sink != None:
+        start_time = time.perf_counter()
+
+    num_chars = 0
+    with open(filename, 'rb') as in_file, open(outfilename, 'wb') as out_file:
+        out_file.write(STREAM_FILE_MAGIC)
+        out_file.write(bytes([STREAM_FILE_VERSION, num_streams]))
+
+        block = in_file.read(block_size)
+        while block:
+            (code_table, len_table) = STREAM_TABLE_CACHE.get_codes(gen_histogram(block))
+            packed_lengths = pack_code_lengths(len_table)
+            enc_bytes = encode_streams(block, code_table, len_table, num_streams)
+            out_file.write(len(block).to_bytes(4, 'big'))
+            out_file.write(len(packed_lengths).to_bytes(2, 'big'))
+            out_file.write(len(enc_bytes).to_bytes(4, 'big'))
+            out_file.write(packed_lengths)
+            out_file.write(enc_bytes)
+            num_chars += len(block)
+            block = in_file.read(block_size)
+
+        out_file.write(bytes(STREAM_HEADER_SIZE))
+
+        if sink != None:
+            emit_metrics(sink, 'file_encode', start_time,
+                         bytes_in=num_chars, bytes_out=out_file.tell())
+
+    return 0
+
+
+#-------------------------------------------------------------------
+# huffman_decode_streams()
+#
+# Decode a multi stream file written by huffman_encode_streams()
+# and write the decoded data to the file outfilename, one block
+# at a time.
+#-------------------------------------------------------------------
+def huffman_decode_streams(filename, outfilename):
+    sink = get_metrics_sink()
+    if sink != None:
+        start_time = time.perf_counter()
+
+    num_chars = 0
+    with open(filename, 'rb') as in_file, open(outfilename, 'wb') as out_file:
+        header = in_file.read(len(STREAM_FILE_MAGIC) + 2)
+        if len(header) < len(STREAM_FILE_MAGIC) + 2 or\
+           header[0 : len(STREAM_FILE_MAGIC)] != STREAM_FILE_MAGIC:
+            raise ValueError("Not a Huffman multi stream file.")
+        if header[-2] != STREAM_FILE_VERSION:
+            raise ValueError("Unsupported multi stream file version %d." % header[-2])
+        num_streams = header[-1]
+
+        while True:
+            block_header = in_file.read(STREAM_HEADER_SIZE)
+            if len(block_header) < STREAM_HEADER_SIZE:
+                raise ValueError("Multi stream file ended before the last block.")
+            block_chars = int.from_bytes(block_header[0 : 4], 'big')
+            table_size = int.from_bytes(block_header[4 : 6], 'big')
+            enc_size = int.from_bytes(block_header[6 : 10], 'big')
+            if not block_chars:
+                break
+
+            (len_table, pos) = unpack_code_lengths(in_file.read(table_size), NUM_SYMBOLS)
+            decode_tables = gen_decode_tables(gen_canonical_codes(len_table), len_table)
+            out_file.write(decode_streams(in_file.read(enc_size), decode_tables,
+                                          block_chars, num_streams))
+            num_chars += block_chars
+
+        if sink != None:
+            emit_metrics(sink, 'file_decode', start_time,
+                         bytes_in=in_file.tell(), bytes_out=num_chars)
+
+    return 0
 
 
 #-------------------------------------------------------------------
@@ -280,7 +666,7 @@ def gen_encoded_list(my_list, my_codes):
 
     my_enclist = []
     for node in my_list:
-        print node
+        print(node)
 
     return my_enclist
 
@@ -292,7 +678,36 @@ def gen_encoded_list(my_list, my_codes):
 # as given by the arguments.
 #-------------------------------------------------------------------
 def encdec_huffman(args):
-    pass
+    if args.outfile == None:
+        print("Error: No output file given.")
+        return 1
+
+    if args.range and not (args.blocks and args.decode):
+        print("Error: A range can only be decoded in block mode.")
+        return 1
+
+    if args.streams != None:
+        if args.decode:
+            return huffman_decode_streams(args.infile, args.outfile)
+        else:
+            return huffman_encode_streams(args.infile, args.outfile, args.streams)
+
+    if args.blocks:
+        if args.decode and args.range:
+            (start, length) = args.range
+            save_file(args.outfile, huffman_decode_range(args.infile, start, length))
+            return 0
+        if args.decode:
+            return huffman_decode_blocks(args.infile, args.outfile,
+                                         workers=args.jobs)
+        else:
+            return huffman_encode_blocks(args.infile, args.outfile,
+                                         workers=args.jobs)
+
+    if args.decode:
+        return huffman_decode(args.infile, args.outfile)
+    else:
+        return huffman_encode(args.infile, args.outfile)
 
 
 #-------------------------------------------------------------------
@@ -340,6 +755,28 @@ def test_huffman():
     my_encoded_list = gen_encoded_list(my_list, my_codes)
 
 
+#-------------------------------------------------------------------
+# test_block_headers()
+#
+# Encode blocks of different sizes from the given file with
+# encode_block(), the path used when writing files, and check
+# that the packed code lengths are decoded back and are much
+# smaller than one byte per char.
+#-------------------------------------------------------------------
+def test_block_headers(filename):
+    my_bytestring = bytes(load_file(filename))
+    for block_size in (1, 64, 1024, len(my_bytestring)):
+        block = my_bytestring[: block_size]
+        (packed_lengths, enc_bytes, sync_offsets) = encode_block(block)
+        (len_table, pos) = unpack_code_lengths(packed_lengths, NUM_SYMBOLS)
+        assert pos == len(packed_lengths)
+        assert sum(1 for length in len_table if length) == len(set(block))
+        assert len(packed_lengths) * 4 <= NUM_SYMBOLS
+        assert decode_segment(packed_lengths, enc_bytes, 0, len(block)) == block
+        print("Block of %d bytes: %d byte header instead of %d." %\
+              (len(block), len(packed_lengths), NUM_SYMBOLS))
+
+
 #-------------------------------------------------------------------
 # main()
 #
@@ -368,18 +805,38 @@ def main():
     parser.add_argument('-e', '--encode', action='store_true',
                         help='Perform Huffman encoding.')
 
+    parser.add_argument('-b', '--blocks', action='store_true',
+                        help='Use independent blocks encoded in parallel.')
+
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of worker processes in block mode.')
+
+    parser.add_argument('-r', '--range', type=int, nargs=2,
+                        metavar=('OFFSET', 'LENGTH'),
+                        help='Only decode LENGTH bytes from OFFSET in block mode.')
+
+    parser.add_argument('-s', '--streams', type=int, nargs='?', const=NUM_STREAMS,
+                        help='Use the multi stream format, with STREAMS sub-streams '
+                        'per block when encoding (default %d). With fewer than %d '
+                        'the sub-streams are decoded one after another.' %\
+                        (NUM_STREAMS, NUMPY_MIN_LANES))
+
     parser.add_argument('--version', action='version', version=VERSION)
 
     args = parser.parse_args()
 
     if args.infile==None and not args.test:
-        print "Error: No input file given and not in test mode."
+        print("Error: No input file given and not in test mode.")
         exit(1)
 
+    if args.verbose:
+        set_metrics_sink(print_metrics)
+
     if args.test:
         test_huffman()
+        test_block_headers(args.infile or __file__)
     else:
-        huffman_encdec(args)
+        return encdec_huffman(args)
 
 
 #-------------------------------------------------------------------
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#=======================================================================
+#
+# huffman_adaptive.py
+# -------------------
+# Adaptive (one-pass) Huffman coding using the FGK algorithm.
+# The encoder and decoder start with the same empty tree and
+# update it after every symbol, so no pre-scan of the data is
+# needed and no code table is transmitted. Suitable for streams
+# of unknown length such as pipes and sockets.
+#
+#
+# Author: Joachim Strömbergson
+# Copyright (c) 2014, Secworks Sweden AB
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#=======================================================================
+
+#-------------------------------------------------------------------
+# Python module imports.
+#-------------------------------------------------------------------
+import sys
+import time
+import argparse
+
+from prefix_tuple_tree import flush_bits, load_file
+from prefix_tuple_tree import get_metrics_sink, emit_metrics
+from prefix_tuple_tree import NUM_SYMBOLS, CHUNK_SIZE
+
+
+#-------------------------------------------------------------------
+# Constants.
+#-------------------------------------------------------------------
+VERBOSE = False
+
+# The end of stream symbol follows the byte symbols. New symbols
+# are sent as the NYT code followed by SYMBOL_BITS raw bits.
+EOS_SYMBOL = NUM_SYMBOLS
+SYMBOL_BITS = 9
+MAX_NODES = 2 * (NUM_SYMBOLS + 1) + 1
+
+
+#-------------------------------------------------------------------
+# class AdaptiveModel
+#
+# The adaptive Huffman tree shared (as identical copies) by the
+# encoder and the decoder. Nodes are indices into parallel lists
+# with weight, parent, left and right child (-1 for none). Each
+# node also has an implicit number, with order[number] giving
+# the node. Numbers are kept in increasing weight order (the
+# sibling property), which is what update() maintains.
+#
+# New nodes are split off the NYT (not yet transmitted) node,
+# which is always a leaf with weight zero.
+#-------------------------------------------------------------------
+class AdaptiveModel:
+    def __init__(self):
+        self.weight = [0] * MAX_NODES
+        self.parent = [-1] * MAX_NODES
+        self.left = [-1] * MAX_NODES
+        self.right = [-1] * MAX_NODES
+        self.number = [0] * MAX_NODES
+        self.order = [0] * MAX_NODES
+        self.symbol = [-1] * MAX_NODES
+        self.leaf = [-1] * (NUM_SYMBOLS + 1)
+
+        self.root = 0
+        self.nyt = 0
+        self.num_nodes = 1
+        self.number[0] = MAX_NODES - 1
+        self.order[MAX_NODES - 1] = 0
+        self.finished = False
+
+    def print_fields(self):
+        print("Adaptive model with %d nodes and total weight %d" %\
+              (self.num_nodes, self.weight[self.root]))
+
+
+    #---------------------------------------------------------------
+    # get_code()
+    #
+    # Returns a tuple (code, length) with the current code for
+    # the given node, found by walking from the node to the root.
+    #---------------------------------------------------------------
+    def get_code(self, node):
+        parent = self.parent
+        right = self.right
+        code = 0
+        length = 0
+        while node != self.root:
+            p = parent[node]
+            if right[p] == node:
+                code |= 1 << length
+            length += 1
+            node = p
+        return (code, length)
+
+
+    #---------------------------------------------------------------
+    # split_nyt()
+    #
+    # Give the NYT node two children, a new NYT node (left) and a
+    # leaf for the given symbol (right). Returns the new leaf.
+    #---------------------------------------------------------------
+    def split_nyt(self, sym):
+        old_nyt = self.nyt
+        nyt_number = self.number[old_nyt]
+        new_nyt = self.num_nodes
+        new_leaf = self.num_nodes + 1
+        self.num_nodes += 2
+
+        for (node, number) in ((new_leaf, nyt_number - 1), (new_nyt, nyt_number - 2)):
+            self.parent[node] = old_nyt
+            self.number[node] = number
+            self.order[number] = node
+
+        self.left[old_nyt] = new_nyt
+        self.right[old_nyt] = new_leaf
+        self.symbol[new_leaf] = sym
+        self.leaf[sym] = new_leaf
+        self.nyt = new_nyt
+        return new_leaf
+
+
+    #---------------------------------------------------------------
+    # swap_nodes()
+    #
+    # Swap the positions (and numbers) of two nodes in the tree.
+    # Neither node may be an ancestor of the other.
+    #---------------------------------------------------------------
+    def swap_nodes(self, a, b):
+        parent = self.parent
+        pa = parent[a]
+        pb = parent[b]
+        if pa == pb:
+            (self.left[pa], self.right[pa]) = (self.right[pa], self.left[pa])
+        else:
+            if self.left[pa] == a:
+                self.left[pa] = b
+            else:
+                self.right[pa] = b
+            if self.left[pb] == b:
+                self.left[pb] = a
+            else:
+                self.right[pb] = a
+            parent[a] = pb
+            parent[b] = pa
+
+        number = self.number
+        (number[a], number[b]) = (number[b], number[a])
+        self.order[number[a]] = a
+        self.order[number[b]] = b
+
+
+    #---------------------------------------------------------------
+    # update()
+    #
+    # Update the tree after coding the given symbol. Walks from
+    # the leaf to the root, swapping each node with the highest
+    # numbered node of the same weight (its block leader) before
+    # incrementing its weight.
+    #---------------------------------------------------------------
+    def update(self, sym):
+        node = self.leaf[sym]
+        if node == -1:
+            node = self.split_nyt(sym)
+
+        weight = self.weight
+        number = self.number
+        order = self.order
+        while node != -1:
+            node_weight = weight[node]
+            leader_number = number[node]
+            while leader_number + 1 < MAX_NODES and\
+                  weight[order[leader_number + 1]] == node_weight:
+                leader_number += 1
+            leader = order[leader_number]
+            if leader != node and leader != self.parent[node]:
+                self.swap_nodes(node, leader)
+            weight[node] = node_weight + 1
+            node = self.parent[node]
+
+
+#-------------------------------------------------------------------
+# adaptive_encode_chunk()
+#
+# Encode the given chunk of bytes with the given model, updating
+# the model. The acc and acc_bits args are the bits left over
+# from the previous chunk. Returns a tuple (dst_bytes, acc,
+# acc_bits) in the same way as bitencode_chunk().
+#-------------------------------------------------------------------
+def adaptive_encode_chunk(src_bytes, model, acc, acc_bits):
+    sink = get_metrics_sink()
+    if sink != None:
+        start_time = time.perf_counter()
+
+    src_bytes = memoryview(src_bytes).cast('B')
+    dst_bytes = bytearray()
+    leaf = model.leaf
+    for ch in src_bytes:
+        node = leaf[ch]
+        if node == -1:
+            (code, length) = model.get_code(model.nyt)
+            code = (code << SYMBOL_BITS) | ch
+            length += SYMBOL_BITS
+        else:
+            (code, length) = model.get_code(node)
+        model.update(ch)
+
+        acc = (acc << length) | code
+        acc_bits += length
+        if acc_bits >= 32:
+            acc_bits -= 32
+            dst_bytes += (acc >> acc_bits).to_bytes(4, 'big')
+            acc &= (1 << acc_bits) - 1
+
+    if sink != None:
+        emit_metrics(sink, 'adaptive_encode', start_time,
+                     bytes_in=len(src_bytes), bytes_out=len(dst_bytes))
+    return (dst_bytes, acc, acc_bits)
+
+
+#-------------------------------------------------------------------
+# adaptive_flush()
+#
+# Encode the end of stream symbol and return the remaining bits
+# as bytes. Must be called once after the last chunk.
+#-------------------------------------------------------------------
+def adaptive_flush(model, acc, acc_bits):
+    (code, length) = model.get_code(model.nyt)
+    acc = (((acc << length) | code) << SYMBOL_BITS) | EOS_SYMBOL
+    model.finished = True
+    return flush_bits(acc, acc_bits + length + SYMBOL_BITS)
+
+
+#-------------------------------------------------------------------
+# adaptive_decode_chunk()
+#
+# Decode the given chunk of encoded bytes with the given model,
+# updating the model. Decoding stops when the chunk runs out in
+# the middle of a code, the unused bits are returned in acc and
+# acc_bits for the next chunk. When the end of stream symbol is
+# decoded model.finished is set and the rest of the chunk is
+# ignored. Returns a tuple (dst_bytes, acc, acc_bits).
+#-------------------------------------------------------------------
+def adaptive_decode_chunk(src_bytes, model, acc, acc_bits):
+    sink = get_metrics_sink()
+    if sink != None:
+        start_time = time.perf_counter()
+
+    src_bytes = memoryview(src_bytes).cast('B')
+    src_len = len(src_bytes)
+    src_pos = 0
+    dst_bytes = bytearray()
+    left = model.left
+    right = model.right
+    symbol = model.symbol
+
+    while not model.finished:
+        node = model.root
+        pos = acc_bits
+        while left[node] != -1:
+            if pos == 0:
+                if src_pos == src_len:
+                    break
+                acc = (acc << 8) | src_bytes[src_pos]
+                src_pos += 1
+                acc_bits += 8
+                pos = 8
+            pos -= 1
+            if (acc >> pos) & 1:
+                node = right[node]
+            else:
+                node = left[node]
+        if left[node] != -1:
+            break
+
+        if node == model.nyt:
+            while pos < SYMBOL_BITS and src_pos < src_len:
+                acc = (acc << 8) | src_bytes[src_pos]
+                src_pos += 1
+                acc_bits += 8
+                pos += 8
+            if pos < SYMBOL_BITS:
+                break
+            pos -= SYMBOL_BITS
+            sym = (acc >> pos) & ((1 << SYMBOL_BITS) - 1)
+        else:
+            sym = symbol[node]
+
+        acc_bits = pos
+        acc &= (1 << pos) - 1
+        if sym == EOS_SYMBOL:
+            model.finished = True
+        elif sym > EOS_SYMBOL:
+            raise ValueError("Invalid symbol %d in adaptive stream." % sym)
+        else:
+            dst_bytes.append(sym)
+            model.update(sym)
+
+    if sink != None:
+        emit_metrics(sink, 'adaptive_decode', start_time,
+                     bytes_in=src_pos, bytes_out=len(dst_bytes))
+    return (dst_bytes, acc, acc_bits)
+
+
+#-------------------------------------------------------------------
+# adaptive_encode_bytes()
+#
+# Encode the given bytes into a complete adaptive stream.
+#-------------------------------------------------------------------
+def adaptive_encode_bytes(src_bytes):
+    model = AdaptiveModel()
+    (dst_bytes, acc, acc_bits) = adaptive_encode_chunk(src_bytes, model, 0, 0)
+    dst_bytes += adaptive_flush(model, acc, acc_bits)
+    return dst_bytes
+
+
+#-------------------------------------------------------------------
+# adaptive_decode_bytes()
+#
+# Decode a complete adaptive stream.
+#-------------------------------------------------------------------
+def adaptive_decode_bytes(src_bytes):
+    model = AdaptiveModel()
+    (dst_bytes, acc, acc_bits) = adaptive_decode_chunk(src_bytes, model, 0, 0)
+    if not model.finished:
+        raise ValueError("Adaptive stream ended before the end of stream symbol.")
+    return dst_bytes
+
+
+#-------------------------------------------------------------------
+# adaptive_stream()
+#
+# Encode or decode from the given binary input file object to
+# the given output file object in chunks, without knowing the
+# length of the input in advance. Uses read1() so that data from
+# a pipe or socket is processed as soon as it arrives.
+#-------------------------------------------------------------------
+def adaptive_stream(in_file, out_file, decode, chunk_size = CHUNK_SIZE):
+    model = AdaptiveModel()
+    acc = 0
+    acc_bits = 0
+    while not model.finished:
+        chunk = in_file.read1(chunk_size)
+        if not chunk:
+            if decode:
+                raise ValueError("Adaptive stream ended before the end of stream symbol.")
+            out_file.write(adaptive_flush(model, acc, acc_bits))
+            break
+
+        if decode:
+            (dst_bytes, acc, acc_bits) = adaptive_decode_chunk(chunk, model, acc, acc_bits)
+        else:
+            (dst_bytes, acc, acc_bits) = adaptive_encode_chunk(chunk, model, acc, acc_bits)
+        out_file.write(dst_bytes)
+    out_file.flush()
+
+
+#-------------------------------------------------------------------
+# test_adaptive()
+#
+# Encode and decode the given file, both in one go and in small
+# chunks, and check that the data survives.
+#-------------------------------------------------------------------
+def test_adaptive(filename):
+    data = bytes(load_file(filename))
+    enc_bytes = adaptive_encode_bytes(data)
+    assert adaptive_decode_bytes(enc_bytes) == data
+
+    model = AdaptiveModel()
+    acc = 0
+    acc_bits = 0
+    dec_bytes = bytearray()
+    for i in range(0, len(enc_bytes), 7):
+        (chunk, acc, acc_bits) = adaptive_decode_chunk(enc_bytes[i : i + 7],
+                                                       model, acc, acc_bits)
+        dec_bytes += chunk
+    assert model.finished and dec_bytes == data
+
+    for test_data in [b'', b'a', b'aaaa', bytes(range(256)) * 3]:
+        assert adaptive_decode_bytes(adaptive_encode_bytes(test_data)) == test_data
+
+    print("Adaptive coding of %s: %d bytes to %d bytes." %\
+          (filename, len(data), len(enc_bytes)))
+
+
+#-------------------------------------------------------------------
+# main()
+#
+# Encode or decode a stream. Input and output default to stdin
+# and stdout so the coder can be used in a pipe.
+#-------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-i', '--infile',
+                        help='The input file, stdin if not given.')
+
+    parser.add_argument('-o', '--outfile',
+                        help='The output file, stdout if not given.')
+
+    parser.add_argument('-d', '--decode', action='store_true',
+                        help='Perform decoding instead of encoding.')
+
+    args = parser.parse_args()
+
+    if args.infile != None:
+        in_file = open(args.infile, 'rb')
+    else:
+        in_file = sys.stdin.buffer
+
+    if args.outfile != None:
+        out_file = open(args.outfile, 'wb')
+    else:
+        out_file = sys.stdout.buffer
+
+    with in_file, out_file:
+        adaptive_stream(in_file, out_file, args.decode)
+    return 0
+
+
+#-------------------------------------------------------------------
+# __name__
+# Python thingy which allows the file to be run standalone as
+# well as parsed from within a Python interpreter.
+#-------------------------------------------------------------------
+if __name__=="__main__":
+    # Run the main function.
+    sys.exit(main())
+
+#=======================================================================
+# EOF huffman_adaptive.py
+#=======================================================================
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#=======================================================================
+#
+# huffman_async.py
+# ----------------
+# asyncio stream API for the Huffman coder. Data is read from an
+# asyncio.StreamReader in blocks, each block is coded in an
+# executor so that the event loop is never stalled, and the
+# result is written to an asyncio.StreamWriter, waiting for the
+# writer to drain before the next block is written.
+#
+#
+# Author: Joachim Strömbergson
+# Copyright (c) 2014, Secworks Sweden AB
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#=======================================================================
+
+#-------------------------------------------------------------------
+# Python module imports.
+#-------------------------------------------------------------------
+import sys
+import socket
+import asyncio
+
+from huffman import encode_block, decode_segment
+from prefix_tuple_tree import load_file
+
+
+#-------------------------------------------------------------------
+# Constants.
+#-------------------------------------------------------------------
+VERBOSE = False
+
+STREAM_MAGIC = b'HUFS'
+STREAM_VERSION = 2
+STREAM_BLOCK_SIZE = 1 << 16
+
+# Each frame starts with the number of chars (4 bytes), the
+# number of encoded bytes (4 bytes) and the size of the packed
+# code lengths (2 bytes), followed by the code lengths and the
+# encoded bytes. A frame with zero chars ends the stream.
+FRAME_HEADER_SIZE = 10
+
+
+#-------------------------------------------------------------------
+# read_block()
+#
+# Read up to block_size bytes from the given reader. Returns
+# fewer bytes only at the end of the stream.
+#-------------------------------------------------------------------
+async def read_block(reader, block_size):
+    try:
+        return await reader.readexactly(block_size)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+
+#-------------------------------------------------------------------
+# encode_frame()
+#
+# Encode the given block into a complete frame. Run in the
+# executor by encode_stream().
+#-------------------------------------------------------------------
+def encode_frame(block):
+    (len_table, enc_bytes, sync_offsets) = encode_block(block, max(1, len(block)))
+    return len(block).to_bytes(4, 'big') + len(enc_bytes).to_bytes(4, 'big') +\
+        len(len_table).to_bytes(2, 'big') + len_table + enc_bytes
+
+
+#-------------------------------------------------------------------
+# encode_stream()
+#
+# Encode everything read from the reader until end of stream and
+# write it as a frame stream to the writer. Each block is encoded
+# in the given executor (the default executor if None) while the
+# next block is read. At most one encoded frame is waiting to be
+# written, and drain() is awaited after each frame so that a slow
+# peer slows down the reading instead of growing buffers. The
+# writer is not closed.
+#-------------------------------------------------------------------
+async def encode_stream(reader, writer, block_size = STREAM_BLOCK_SIZE,
+                        executor = None):
+    loop = asyncio.get_running_loop()
+    writer.write(STREAM_MAGIC + bytes([STREAM_VERSION]))
+
+    pending = None
+    while True:
+        block = await read_block(reader, block_size)
+        if pending != None:
+            writer.write(await pending)
+            await writer.drain()
+            pending = None
+
+        if not block:
+            break
+        pending = loop.run_in_executor(executor, encode_frame, block)
+
+    writer.write(bytes(FRAME_HEADER_SIZE))
+    await writer.drain()
+
+
+#-------------------------------------------------------------------
+# decode_stream()
+#
+# Decode a frame stream written by encode_stream() from the
+# reader and write the decoded data to the writer. Blocks are
+# decoded in the given executor while the next frame is read,
+# with drain() awaited after each block. The writer is not
+# closed.
+#-------------------------------------------------------------------
+async def decode_stream(reader, writer, executor = None):
+    loop = asyncio.get_running_loop()
+    header = await reader.readexactly(len(STREAM_MAGIC) + 1)
+    if header[: len(STREAM_MAGIC)] != STREAM_MAGIC:
+        raise ValueError("Not a Huffman stream.")
+    if header[-1] != STREAM_VERSION:
+        raise ValueError("Unsupported stream version %d." % header[-1])
+
+    pending = None
+    while True:
+        frame_header = await reader.readexactly(FRAME_HEADER_SIZE)
+        num_chars = int.from_bytes(frame_header[0 : 4], 'big')
+        enc_size = int.from_bytes(frame_header[4 : 8], 'big')
+        table_size = int.from_bytes(frame_header[8 : 10], 'big')
+        if num_chars:
+            len_table = await reader.readexactly(table_size)
+            enc_bytes = await reader.readexactly(enc_size)
+
+        if pending != None:
+            writer.write(await pending)
+            await writer.drain()
+            pending = None
+
+        if not num_chars:
+            break
+        pending = loop.run_in_executor(executor, decode_segment, len_table,
+                                       enc_bytes, 0, num_chars)
+
+
+#-------------------------------------------------------------------
+# test_async_stream()
+#
+# Send the given file through encode_stream() and decode_stream()
+# connected with local socket pairs and check that the data
+# survives. A small block size is used to get many frames.
+#-------------------------------------------------------------------
+def test_async_stream(filename, block_size = 1 << 12):
+    data = bytes(load_file(filename))
+
+    async def open_socket_pair():
+        (sock1, sock2) = socket.socketpair()
+        (reader1, writer1) = await asyncio.open_connection(sock=sock1)
+        (reader2, writer2) = await asyncio.open_connection(sock=sock2)
+        return (writer1, reader2, writer2)
+
+    async def run():
+        (raw_writer, raw_reader, raw_end) = await open_socket_pair()
+        (enc_writer, enc_reader, enc_end) = await open_socket_pair()
+        (dec_writer, dec_reader, dec_end) = await open_socket_pair()
+
+        async def send_raw():
+            for i in range(0, len(data), 1000):
+                raw_writer.write(data[i : i + 1000])
+                await raw_writer.drain()
+            raw_writer.write_eof()
+
+        async def encode():
+            await encode_stream(raw_reader, enc_writer, block_size)
+            enc_writer.write_eof()
+
+        async def decode():
+            await decode_stream(enc_reader, dec_writer)
+            dec_writer.write_eof()
+
+        tasks = [asyncio.create_task(task()) for task in (send_raw, encode, decode)]
+        dec_data = await dec_reader.read()
+        await asyncio.gather(*tasks)
+        for writer in (raw_writer, raw_end, enc_writer, enc_end, dec_writer, dec_end):
+            writer.close()
+        return dec_data
+
+    assert asyncio.run(run()) == data
+    print("Async stream of %d bytes ok." % len(data))
+
+
+#-------------------------------------------------------------------
+# main()
+#-------------------------------------------------------------------
+def main():
+    test_async_stream(sys.argv[1] if len(sys.argv) > 1 else __file__)
+    return 0
+
+
+#-------------------------------------------------------------------
+# __name__
+# Python thingy which allows the file to be run standalone as
+# well as parsed from within a Python interpreter.
+#-------------------------------------------------------------------
+if __name__=="__main__":
+    # Run the main function.
+    sys.exit(main())
+
+#=======================================================================
+# EOF huffman_async.py
+#=======================================================================
@@ -0,0 +1,595 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#=======================================================================
+#
+# huffman_bench.py
+# ----------------
+# Throughput benchmarks for the Huffman coder. Generates a corpus
+# of data with different statistics and sizes and measures the
+# time and memory used by each stage: histogram, tree build, code
+# extraction, encode and decode. The results are written as JSON
+# lines so that runs on different commits can be compared.
+#
+#
+# Author: Joachim Strömbergson
+# Copyright (c) 2014, Secworks Sweden AB
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#=======================================================================
+
+#-------------------------------------------------------------------
+# Python module imports.
+#-------------------------------------------------------------------
+import sys
+import json
+import time
+import zlib
+import random
+import struct
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from huffman_adaptive import adaptive_encode_bytes, adaptive_decode_bytes
+from huffman_tokens import encode_tokens, decode_tokens, TOKENIZERS
+from huffman_context import encode_context, decode_context, MAX_CONTEXT_TABLES
+from prefix_tuple_tree import gen_random_node_list, gen_histogram
+from prefix_tuple_tree import gen_histogram_node_list, gen_prefix_tree
+from prefix_tuple_tree import extract_canonical_codes, bitencode_bytes
+from prefix_tuple_tree import gen_decode_tables, decode_bytes
+from prefix_tuple_tree import gen_histogram_canonical_codes
+from prefix_tuple_tree import encode_batch, decode_batch
+
+
+#-------------------------------------------------------------------
+# Constants.
+#-------------------------------------------------------------------
+VERBOSE = False
+
+CORPORA = ['uniform', 'zipf', 'geometric', 'single', 'text', 'binary',
+           'compressed']
+SIZES = [1 << 10, 1 << 16, 1 << 20]
+STAGES = ['histogram', 'tree', 'codes', 'encode', 'decode']
+
+# Data larger than this is built by repeating a generated
+# base of this size.
+BASE_SIZE = 1 << 20
+
+WORDS = ['the', 'of', 'and', 'to', 'in', 'a', 'is', 'that', 'for', 'it',
+         'as', 'was', 'with', 'be', 'by', 'on', 'not', 'he', 'this', 'are',
+         'or', 'his', 'from', 'at', 'which', 'but', 'have', 'an', 'had',
+         'they', 'you', 'were', 'their', 'one', 'all', 'we', 'can', 'her',
+         'has', 'there', 'been', 'if', 'more', 'when', 'will', 'would',
+         'who', 'so', 'no', 'huffman', 'prefix', 'tree', 'node', 'weight',
+         'code', 'length', 'symbol', 'table', 'block', 'stream', 'bits']
+
+
+#-------------------------------------------------------------------
+# gen_dist_node_list()
+#
+# Generates a list of max_types nodes where the weights follow
+# the given distribution. Works like gen_random_node_list(),
+# which is used for the uniform distribution.
+#-------------------------------------------------------------------
+def gen_dist_node_list(dist, max_types, max_nums):
+    if dist == 'uniform':
+        return gen_random_node_list(max_types, max_nums)
+
+    if dist == 'zipf':
+        weights = [max_nums // (i + 1) for i in range(max_types)]
+    elif dist == 'geometric':
+        weights = [int(max_nums * (0.5 ** i)) for i in range(max_types)]
+    elif dist == 'single':
+        weights = [max_nums] + [0] * (max_types - 1)
+    else:
+        raise ValueError("Unknown distribution '%s'." % dist)
+
+    chars = list(range(max_types))
+    random.shuffle(chars)
+    return [(chars[i], weights[i], 0, None, None) for i in range(max_types)]
+
+
+#-------------------------------------------------------------------
+# gen_base_data()
+#
+# Generates size bytes of data of the given kind.
+#-------------------------------------------------------------------
+def gen_base_data(kind, size):
+    if kind in ('uniform', 'zipf', 'geometric', 'single'):
+        nlist = [node for node in gen_dist_node_list(kind, 256, 1 << 20)
+                 if node[1] > 0]
+        return bytes(random.choices([node[0] for node in nlist],
+                                    weights=[node[1] for node in nlist],
+                                    k=size))
+
+    if kind == 'text':
+        weights = [1.0 / (i + 1) for i in range(len(WORDS))]
+        text = bytearray()
+        while len(text) < size:
+            line = random.choices(WORDS, weights=weights,
+                                  k=random.randint(4, 16))
+            text += (' '.join(line).capitalize() + '.\n').encode('ascii')
+        return bytes(text[:size])
+
+    if kind == 'binary':
+        data = bytearray()
+        while len(data) < size:
+            data += struct.pack('<IHhd', random.randint(0, 1 << 16),
+                                random.randint(0, 255),
+                                random.randint(-1000, 1000),
+                                random.gauss(0.0, 1.0))
+        return bytes(data[:size])
+
+    if kind == 'compressed':
+        data = bytearray()
+        while len(data) < size:
+            data += zlib.compress(gen_base_data('text', 1 << 16), 9)
+        return bytes(data[:size])
+
+    raise ValueError("Unknown corpus '%s'." % kind)
+
+
+#-------------------------------------------------------------------
+# gen_corpus()
+#
+# Generates size bytes of data of the given kind. The data is
+# generated from the given seed, so the same corpus is used by
+# every run. Data larger than BASE_SIZE repeats a base block,
+# copied into a buffer of exactly size bytes.
+#-------------------------------------------------------------------
+def gen_corpus(kind, size, seed = 0):
+    random.seed("%s-%d" % (kind, seed))
+    base = gen_base_data(kind, min(size, BASE_SIZE))
+    if size <= len(base):
+        return base
+
+    data = bytearray(size)
+    for start in range(0, size, len(base)):
+        data[start : start + len(base)] = base[: size - start]
+    return data
+
+
+#-------------------------------------------------------------------
+# time_stage()
+#
+# Run the given function repeats times and return a tuple
+# (result, best time in seconds, peak bytes). The function is
+# then run once more with tracemalloc on to get the peak bytes
+# allocated by the stage itself, as tracing slows down the
+# timed runs.
+#-------------------------------------------------------------------
+def time_stage(func, repeats):
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+
+    tracemalloc.start()
+    try:
+        func()
+        (current, peak) = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return (result, best, peak)
+
+
+#-------------------------------------------------------------------
+# bench_case()
+#
+# Benchmark all stages for one corpus kind and size. Returns a
+# list of result dicts, one per stage.
+#
+# If adaptive is set the one-pass adaptive coder is benchmarked
+# as well, together with a two_pass stage with the total time
+# of the static encode stages for comparison.
+#-------------------------------------------------------------------
+def bench_case(kind, size, repeats, adaptive = False):
+    data = gen_corpus(kind, size)
+    results = []
+
+    def add_result(stage, elapsed, num_symbols, peak):
+        results.append({'corpus' : kind, 'size' : size, 'stage' : stage,
+                        'seconds' : elapsed,
+                        'mb_per_s' : size / (1024 * 1024) / max(elapsed, 1E-9),
+                        'ns_per_symbol' : 1E9 * elapsed / max(1, num_symbols),
+                        'peak_mem' : peak})
+
+    (freq_list, elapsed, peak) = time_stage(lambda: gen_histogram(data), repeats)
+    add_result('histogram', elapsed, size, peak)
+
+    nlist = gen_histogram_node_list(freq_list)
+    (ptree, elapsed, peak) = time_stage(lambda: gen_prefix_tree(nlist), repeats)
+    add_result('tree', elapsed, len(nlist), peak)
+
+    ((code_table, len_table), elapsed, peak) =\
+        time_stage(lambda: extract_canonical_codes(ptree), repeats)
+    add_result('codes', elapsed, len(nlist), peak)
+
+    (enc_bytes, elapsed, peak) =\
+        time_stage(lambda: bitencode_bytes(data, code_table, len_table), repeats)
+    add_result('encode', elapsed, size, peak)
+
+    def decode():
+        decode_tables = gen_decode_tables(code_table, len_table)
+        return decode_bytes(enc_bytes, decode_tables, size)
+
+    (dec_bytes, elapsed, peak) = time_stage(decode, repeats)
+    add_result('decode', elapsed, size, peak)
+
+    if dec_bytes != data:
+        raise ValueError("Decoded %s data of size %d differs." % (kind, size))
+
+    for result in results:
+        result['ratio'] = len(enc_bytes) / max(1, size)
+
+    if adaptive:
+        two_pass = [result for result in results if result['stage'] != 'decode']
+        add_result('two_pass', sum(result['seconds'] for result in two_pass), size,
+                   max(result['peak_mem'] for result in two_pass))
+        results[-1]['ratio'] = len(enc_bytes) / max(1, size)
+
+        (enc_bytes, elapsed, peak) =\
+            time_stage(lambda: adaptive_encode_bytes(data), repeats)
+        add_result('adaptive_encode', elapsed, size, peak)
+
+        (dec_bytes, elapsed, peak) =\
+            time_stage(lambda: adaptive_decode_bytes(enc_bytes), repeats)
+        add_result('adaptive_decode', elapsed, size, peak)
+
+        if dec_bytes != data:
+            raise ValueError("Adaptive decoded %s data of size %d differs." %\
+                             (kind, size))
+        for result in results[-2:]:
+            result['ratio'] = len(enc_bytes) / max(1, size)
+
+    return results
+
+
+#-------------------------------------------------------------------
+# bench_tokens()
+#
+# Benchmark the token alphabet coder with each tokenizer for one
+# corpus kind and size. The byte tokenizer gives the baseline
+# for the larger alphabets. Returns a list of result dicts.
+#-------------------------------------------------------------------
+def bench_tokens(kind, size, repeats):
+    data = gen_corpus(kind, size)
+    results = []
+
+    for name in TOKENIZERS:
+        tokenizer = TOKENIZERS[name]
+        (enc_bytes, enc_elapsed, enc_peak) =\
+            time_stage(lambda: encode_tokens(data, tokenizer), repeats)
+        (dec_bytes, dec_elapsed, dec_peak) =\
+            time_stage(lambda: decode_tokens(enc_bytes), repeats)
+        if dec_bytes != data:
+            raise ValueError("Decoded %s data of size %d differs for %s tokens." %\
+                             (kind, size, name))
+
+        for (stage, elapsed, peak) in ((name + '_encode', enc_elapsed, enc_peak),
+                                       (name + '_decode', dec_elapsed, dec_peak)):
+            results.append({'corpus' : kind, 'size' : size, 'stage' : stage,
+                            'seconds' : elapsed,
+                            'mb_per_s' : size / (1024 * 1024) / max(elapsed, 1E-9),
+                            'ns_per_symbol' : 1E9 * elapsed / max(1, size),
+                            'peak_mem' : peak,
+                            'ratio' : len(enc_bytes) / max(1, size)})
+
+    return results
+
+
+#-------------------------------------------------------------------
+# bench_context()
+#
+# Benchmark the context coder with a single table (order-0) and
+# with order-1 context tables for one corpus kind and size.
+# Returns a list of result dicts.
+#-------------------------------------------------------------------
+def bench_context(kind, size, repeats):
+    data = gen_corpus(kind, size)
+    results = []
+
+    for (name, max_tables) in (('order0', 1), ('order1', MAX_CONTEXT_TABLES)):
+        (enc_bytes, enc_elapsed, enc_peak) =\
+            time_stage(lambda: encode_context(data, max_tables), repeats)
+        (dec_bytes, dec_elapsed, dec_peak) =\
+            time_stage(lambda: decode_context(enc_bytes), repeats)
+        if dec_bytes != data:
+            raise ValueError("Decoded %s data of size %d differs for %s." %\
+                             (kind, size, name))
+
+        for (stage, elapsed, peak) in ((name + '_encode', enc_elapsed, enc_peak),
+                                       (name + '_decode', dec_elapsed, dec_peak)):
+            results.append({'corpus' : kind, 'size' : size, 'stage' : stage,
+                            'seconds' : elapsed,
+                            'mb_per_s' : size / (1024 * 1024) / max(elapsed, 1E-9),
+                            'ns_per_symbol' : 1E9 * elapsed / max(1, size),
+                            'peak_mem' : peak,
+                            'ratio' : len(enc_bytes) / max(1, size)})
+
+    return results
+
+
+#-------------------------------------------------------------------
+# bench_batch()
+#
+# Benchmark coding num_records small records (50 to 500 bytes of
+# text) sharing one code table, both one record at a time with
+# bitencode_bytes() and decode_bytes() and as one batch with
+# encode_batch() and decode_batch(). Returns a list of result
+# dicts, one per path and direction.
+#-------------------------------------------------------------------
+def bench_batch(num_records, repeats):
+    data = gen_corpus('text', BASE_SIZE)
+    random.seed("batch-%d" % num_records)
+    records = []
+    for i in range(num_records):
+        length = random.randint(50, 500)
+        start = random.randint(0, len(data) - length)
+        records.append(data[start : start + length])
+    num_bytes = sum(len(record) for record in records)
+
+    (code_table, len_table) = gen_histogram_canonical_codes(gen_histogram(data))
+    decode_tables = gen_decode_tables(code_table, len_table)
+    results = []
+
+    def add_result(stage, elapsed, peak, enc_size):
+        results.append({'corpus' : 'records', 'size' : num_bytes, 'stage' : stage,
+                        'seconds' : elapsed,
+                        'mb_per_s' : num_bytes / (1024 * 1024) / max(elapsed, 1E-9),
+                        'ns_per_symbol' : 1E9 * elapsed / max(1, num_bytes),
+                        'records_per_s' : num_records / max(elapsed, 1E-9),
+                        'peak_mem' : peak,
+                        'ratio' : enc_size / max(1, num_bytes)})
+
+    def encode_records():
+        return [bitencode_bytes(record, code_table, len_table) for record in records]
+
+    def decode_records():
+        return [decode_bytes(enc_record, gen_decode_tables(code_table, len_table),
+                             len(record))
+                for (enc_record, record) in zip(enc_records, records)]
+
+    (enc_records, elapsed, peak) = time_stage(encode_records, repeats)
+    add_result('record_encode', elapsed, peak, sum(len(enc) for enc in enc_records))
+    (dec_records, elapsed, peak) = time_stage(decode_records, repeats)
+    add_result('record_decode', elapsed, peak, sum(len(enc) for enc in enc_records))
+    if dec_records != records:
+        raise ValueError("Decoded records differ.")
+
+    ((packed_bytes, offsets), elapsed, peak) =\
+        time_stage(lambda: encode_batch(records, code_table, len_table), repeats)
+    add_result('batch_encode', elapsed, peak,
+               len(packed_bytes) + offsets.itemsize * len(offsets))
+    (dec_records, elapsed, peak) =\
+        time_stage(lambda: decode_batch(packed_bytes, offsets, decode_tables), repeats)
+    add_result('batch_decode', elapsed, peak,
+               len(packed_bytes) + offsets.itemsize * len(offsets))
+    if dec_records != records:
+        raise ValueError("Batch decoded records differ.")
+
+    return results
+
+
+#-------------------------------------------------------------------
+# get_run_info()
+#
+# Returns a dict describing the current run: git commit if
+# available, Python version, machine and time.
+#-------------------------------------------------------------------
+def get_run_info():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit' : commit, 'python' : platform.python_version(),
+            'machine' : platform.machine(), 'time' : time.time()}
+
+
+#-------------------------------------------------------------------
+# run_benchmarks()
+#
+# Run the benchmarks for all given corpus kinds and sizes, and
+# the batch benchmark if batch_records is given, the token
+# alphabet benchmarks if tokens is set and the order-1 context
+# benchmarks if context is set. Each case is run in a fresh
+# worker process. The results are printed
+# and, if an output file name is given, written to the file as
+# JSON lines. Returns the list of results.
+#-------------------------------------------------------------------
+def run_benchmarks(corpora, sizes, repeats, outfilename = None,
+                   adaptive = False, batch_records = 0, tokens = False,
+                   context = False):
+    run_info = get_run_info()
+    all_results = []
+
+    print("%-10s %10s %-15s %10s %12s %12s %7s" %\
+          ("corpus", "size", "stage", "MB/s", "ns/symbol", "peak mem", "ratio"))
+    cases = [(bench_case, (kind, size, repeats, adaptive))
+             for kind in corpora for size in sizes]
+    if tokens:
+        cases += [(bench_tokens, (kind, size, repeats))
+                  for kind in corpora for size in sizes]
+    if context:
+        cases += [(bench_context, (kind, size, repeats))
+                  for kind in corpora for size in sizes]
+    if batch_records:
+        cases.append((bench_batch, (batch_records, repeats)))
+
+    for (func, func_args) in cases:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results = executor.submit(func, *func_args).result()
+
+        for result in results:
+            result.update(run_info)
+            print("%-10s %10d %-15s %10.2f %12.1f %12d %7.3f" %\
+                  (result['corpus'], result['size'], result['stage'],
+                   result['mb_per_s'], result['ns_per_symbol'],
+                   result['peak_mem'], result['ratio']))
+        all_results += results
+
+    if outfilename != None:
+        with open(outfilename, 'w') as f:
+            for result in all_results:
+                f.write(json.dumps(result, sort_keys=True) + '\n')
+
+    return all_results
+
+
+#-------------------------------------------------------------------
+# load_results()
+#
+# Load results written by run_benchmarks(). Returns a dict keyed
+# by (corpus, size, stage).
+#-------------------------------------------------------------------
+def load_results(filename):
+    results = {}
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                results[(result['corpus'], result['size'], result['stage'])] = result
+    return results
+
+
+#-------------------------------------------------------------------
+# compare_results()
+#
+# Compare two result files and print the change in throughput
+# for each case found in both. Cases where the new throughput is
+# more than threshold percent lower are marked as regressions.
+# Returns the number of regressions.
+#-------------------------------------------------------------------
+def compare_results(old_filename, new_filename, threshold = 10.0):
+    old_results = load_results(old_filename)
+    new_results = load_results(new_filename)
+    regressions = 0
+
+    print("%-10s %10s %-15s %10s %10s %8s" %\
+          ("corpus", "size", "stage", "old MB/s", "new MB/s", "change"))
+    for key in sorted(old_results):
+        if key not in new_results:
+            continue
+
+        old_mbps = old_results[key]['mb_per_s']
+        new_mbps = new_results[key]['mb_per_s']
+        change = 100.0 * (new_mbps - old_mbps) / max(old_mbps, 1E-9)
+        marker = ""
+        if change < -threshold:
+            marker = " REGRESSION"
+            regressions += 1
+        print("%-10s %10d %-15s %10.2f %10.2f %+7.1f%%%s" %\
+              (key[0], key[1], key[2], old_mbps, new_mbps, change, marker))
+
+    return regressions
+
+
+#-------------------------------------------------------------------
+# parse_size()
+#
+# Parse a size with an optional K, M or G suffix.
+#-------------------------------------------------------------------
+def parse_size(size_str):
+    units = {'K' : 1 << 10, 'M' : 1 << 20, 'G' : 1 << 30}
+    size_str = size_str.strip().upper()
+    if size_str and size_str[-1] in units:
+        return int(size_str[:-1]) * units[size_str[-1]]
+    return int(size_str)
+
+
+#-------------------------------------------------------------------
+# main()
+#
+# Parse arguments and run the benchmarks or compare results.
+#-------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-c', '--corpora', nargs='+', default=CORPORA,
+                        choices=CORPORA,
+                        help='The corpus kinds to benchmark.')
+
+    parser.add_argument('-s', '--sizes', nargs='+', default=None,
+                        help='Data sizes to benchmark, for example 1K 1M 1G.')
+
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help='Number of times to repeat each stage.')
+
+    parser.add_argument('-o', '--outfile',
+                        help='File to write the results to as JSON lines.')
+
+    parser.add_argument('-a', '--adaptive', action='store_true',
+                        help='Also benchmark the adaptive one-pass coder.')
+
+    parser.add_argument('-b', '--batch', type=int, default=0, metavar='RECORDS',
+                        help='Also benchmark batch coding of this many records, '
+                        'for example 1000000.')
+
+    parser.add_argument('-t', '--tokens', action='store_true',
+                        help='Also benchmark the token alphabets against bytes.')
+
+    parser.add_argument('-x', '--context', action='store_true',
+                        help='Also benchmark order-1 context tables against order-0.')
+
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two result files instead of benchmarking.')
+
+    args = parser.parse_args()
+
+    if args.compare:
+        return 1 if compare_results(*args.compare) else 0
+
+    sizes = SIZES
+    if args.sizes:
+        sizes = [parse_size(size) for size in args.sizes]
+
+    run_benchmarks(args.corpora, sizes, args.repeats, args.outfile,
+                   args.adaptive, args.batch, args.tokens, args.context)
+    return 0
+
+
+#-------------------------------------------------------------------
+# __name__
+# Python thingy which allows the file to be run standalone as
+# well as parsed from within a Python interpreter.
+#-------------------------------------------------------------------
+if __name__=="__main__":
+    # Run the main function.
+    sys.exit(main())
+
+#=======================================================================
+# EOF huffman_bench.py
+#=======================================================================
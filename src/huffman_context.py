@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#=======================================================================
+#
+# huffman_context.py
+# ------------------
+# Order-1 context Huffman coding. Each byte is coded with a code
+# table selected by the previous byte. Contexts where a table of
+# their own does not pay for its header share one table, so with
+# a single table this is the normal order-0 coder.
+#
+#
+# Author: Joachim Strömbergson
+# Copyright (c) 2014, Secworks Sweden AB
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#=======================================================================
+
+#-------------------------------------------------------------------
+# Python module imports.
+#-------------------------------------------------------------------
+import sys
+import math
+import time
+from collections import Counter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from prefix_tuple_tree import gen_histogram_canonical_codes, gen_canonical_codes
+from prefix_tuple_tree import gen_decode_tables, flush_bits, load_file
+from prefix_tuple_tree import gen_histogram_code_lengths
+from prefix_tuple_tree import pack_code_lengths, unpack_code_lengths
+from prefix_tuple_tree import get_metrics_sink, emit_metrics, NUM_SYMBOLS
+
+
+#-------------------------------------------------------------------
+# Constants.
+#-------------------------------------------------------------------
+VERBOSE = False
+
+CONTEXT_MAGIC = b'HUFC'
+CONTEXT_VERSION = 2
+
+# Code lengths are limited to keep the many decode tables small.
+CONTEXT_MAX_CODE_LENGTH = 15
+MAX_CONTEXT_TABLES = NUM_SYMBOLS
+
+
+#-------------------------------------------------------------------
+# gen_context_histograms()
+#
+# Returns a list with the byte frequency list for each previous
+# byte context. The first byte has context zero.
+#-------------------------------------------------------------------
+def gen_context_histograms(data):
+    data = memoryview(data).cast('B')
+    context_freqs = [[0] * NUM_SYMBOLS for ctx in range(NUM_SYMBOLS)]
+    if not data:
+        return context_freqs
+
+    if numpy is not None:
+        cur = numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int64)
+        prev = numpy.concatenate(([0], cur[:-1]))
+        counts = numpy.bincount(prev * NUM_SYMBOLS + cur,
+                                minlength=NUM_SYMBOLS * NUM_SYMBOLS)
+        for i in numpy.flatnonzero(counts):
+            context_freqs[i // NUM_SYMBOLS][i % NUM_SYMBOLS] = int(counts[i])
+    else:
+        counts = Counter(zip(bytes(1) + bytes(data[:-1]), data))
+        for ((ctx, char), count) in counts.items():
+            context_freqs[ctx][char] = count
+
+    return context_freqs
+
+
+#-------------------------------------------------------------------
+# get_cross_entropy_bits()
+#
+# Returns the estimated number of bits needed to code the given
+# frequencies with a code built from ref_freqs.
+#-------------------------------------------------------------------
+def get_cross_entropy_bits(freq_list, ref_freqs):
+    ref_total = sum(ref_freqs)
+    return sum(freq * math.log2(ref_total / ref_freq)
+               for (freq, ref_freq) in zip(freq_list, ref_freqs) if freq)
+
+
+#-------------------------------------------------------------------
+# gen_context_map()
+#
+# Given the context histograms returns a tuple (context_map,
+# table_freqs) where context_map gives the table for each context
+# and table_freqs the frequency list for each table.
+#
+# Table 0 is shared by the contexts without a table of their own.
+# Contexts are given their own table, most useful first, when
+# the estimated gain over coding them with the shared table is
+# more than the size of their packed table header. At most
+# max_tables tables are used.
+#-------------------------------------------------------------------
+def gen_context_map(context_freqs, max_tables = MAX_CONTEXT_TABLES):
+    order0_freqs = [sum(column) for column in zip(*context_freqs)]
+
+    gains = []
+    for ctx in range(NUM_SYMBOLS):
+        freq_list = context_freqs[ctx]
+        if sum(freq_list):
+            header_bits = 8 * len(pack_code_lengths(gen_histogram_code_lengths(freq_list)))
+            gain = get_cross_entropy_bits(freq_list, order0_freqs) -\
+                get_cross_entropy_bits(freq_list, freq_list) - header_bits
+            if gain > 0:
+                gains.append((gain, ctx))
+    gains.sort(reverse=True)
+
+    context_map = [0] * NUM_SYMBOLS
+    table_freqs = [[0] * NUM_SYMBOLS]
+    for (gain, ctx) in gains[: max_tables - 1]:
+        context_map[ctx] = len(table_freqs)
+        table_freqs.append(context_freqs[ctx])
+
+    for ctx in range(NUM_SYMBOLS):
+        if context_map[ctx] == 0:
+            for char in range(NUM_SYMBOLS):
+                table_freqs[0][char] += context_freqs[ctx][char]
+
+    return (context_map, table_freqs)
+
+
+#-------------------------------------------------------------------
+# encode_context()
+#
+# Encode the given data with order-1 context tables, using at
+# most max_tables code tables. With max_tables 1 this is order-0
+# coding. The encoded data holds magic, version, the number of
+# chars (8 bytes), the number of tables, the table for each
+# context and the code lengths for each table, both packed with
+# pack_code_lengths(), and the bits.
+#-------------------------------------------------------------------
+def encode_context(data, max_tables = MAX_CONTEXT_TABLES):
+    sink = get_metrics_sink()
+    if sink != None:
+        start_time = time.perf_counter()
+
+    data = memoryview(data).cast('B')
+    (context_map, table_freqs) = gen_context_map(gen_context_histograms(data),
+                                                 max_tables)
+
+    enc_bytes = bytearray(CONTEXT_MAGIC)
+    enc_bytes.append(CONTEXT_VERSION)
+    enc_bytes += len(data).to_bytes(8, 'big')
+    enc_bytes.append(len(table_freqs) - 1)
+    enc_bytes += pack_code_lengths(context_map)
+
+    # Code and length for each (context, char) pair, indexed by
+    # (context << 8) | char.
+    pair_codes = []
+    pair_lens = []
+    table_codes = []
+    for freq_list in table_freqs:
+        if sum(freq_list):
+            table_codes.append(gen_histogram_canonical_codes(freq_list,
+                                                             CONTEXT_MAX_CODE_LENGTH))
+        else:
+            table_codes.append(([0] * NUM_SYMBOLS, [0] * NUM_SYMBOLS))
+        enc_bytes += pack_code_lengths(table_codes[-1][1])
+    for ctx in range(NUM_SYMBOLS):
+        (code_table, len_table) = table_codes[context_map[ctx]]
+        pair_codes += code_table
+        pair_lens += len_table
+
+    num_bits = sum(map(pair_lens.__getitem__,
+                       ((prev << 8) | char for (prev, char) in
+                        zip(bytes(1) + bytes(data[:-1]), data))))
+    dst_bytes = bytearray((num_bits + 7) >> 3)
+    acc = 0
+    acc_bits = 0
+    prev = 0
+    pos = 0
+    for char in data:
+        idx = (prev << 8) | char
+        length = pair_lens[idx]
+        acc = (acc << length) | pair_codes[idx]
+        acc_bits += length
+        prev = char
+        if acc_bits >= 32:
+            acc_bits -= 32
+            dst_bytes[pos : pos + 4] = (acc >> acc_bits).to_bytes(4, 'big')
+            acc &= (1 << acc_bits) - 1
+            pos += 4
+    last_bytes = flush_bits(acc, acc_bits)
+    dst_bytes[pos : pos + len(last_bytes)] = last_bytes
+    enc_bytes += dst_bytes
+
+    if sink != None:
+        emit_metrics(sink, 'context_encode', start_time, bytes_in=len(data),
+                     bytes_out=len(enc_bytes), tables=len(table_freqs))
+    return enc_bytes
+
+
+#-------------------------------------------------------------------
+# decode_context()
+#
+# Decode data encoded by encode_context(). The decode tables are
+# switched for every char based on the previous char.
+#-------------------------------------------------------------------
+def decode_context(enc_bytes):
+    sink = get_metrics_sink()
+    if sink != None:
+        start_time = time.perf_counter()
+
+    src_bytes = memoryview(enc_bytes).cast('B')
+    pos = len(CONTEXT_MAGIC)
+    if bytes(src_bytes[: pos]) != CONTEXT_MAGIC:
+        raise ValueError("Not a Huffman context file.")
+    if src_bytes[pos] != CONTEXT_VERSION:
+        raise ValueError("Unsupported context file version %d." % src_bytes[pos])
+
+    num_chars = int.from_bytes(src_bytes[pos + 1 : pos + 9], 'big')
+    num_tables = src_bytes[pos + 9] + 1
+    pos += 10
+    (context_map, pos) = unpack_code_lengths(src_bytes, NUM_SYMBOLS, pos)
+    if max(context_map) >= num_tables:
+        raise ValueError("Invalid context map.")
+
+    tables = []
+    for i in range(num_tables):
+        (len_table, pos) = unpack_code_lengths(src_bytes, NUM_SYMBOLS, pos)
+        tables.append(gen_decode_tables(gen_canonical_codes(len_table), len_table))
+    context_tables = [tables[context_map[ctx]] for ctx in range(NUM_SYMBOLS)]
+
+    num_bytes = len(src_bytes)
+    dst_bytes = bytearray(num_chars)
+    acc = 0
+    acc_bits = 0
+    prev = 0
+    for i in range(num_chars):
+        (lookup_bits, max_len, primary, secondary) = context_tables[prev]
+        while acc_bits < max_len and pos < num_bytes:
+            acc = (acc << 8) | src_bytes[pos]
+            pos += 1
+            acc_bits += 8
+
+        if acc_bits >= max_len:
+            window = acc
+            window_bits = acc_bits
+        else:
+            window = acc << (max_len - acc_bits)
+            window_bits = max_len
+
+        entry = primary[(window >> (window_bits - lookup_bits)) & ((1 << lookup_bits) - 1)]
+        if entry < 0:
+            used_bits = lookup_bits
+            while entry < 0:
+                (sub_bits, sub_table) = secondary[-entry - 1]
+                used_bits += sub_bits
+                entry = sub_table[(window >> (window_bits - used_bits)) &\
+                                  ((1 << sub_bits) - 1)]
+
+        length = entry & 0xff
+        if length == 0 or length > acc_bits:
+            raise ValueError("Invalid or truncated code in encoded data.")
+
+        prev = entry >> 8
+        dst_bytes[i] = prev
+        acc_bits -= length
+        acc &= (1 << acc_bits) - 1
+
+    if sink != None:
+        emit_metrics(sink, 'context_decode', start_time, bytes_in=num_bytes,
+                     bytes_out=num_chars)
+    return dst_bytes
+
+
+#-------------------------------------------------------------------
+# test_context()
+#
+# Encode and decode the given file with order-0 and order-1
+# tables and print the size and time of each.
+#-------------------------------------------------------------------
+def test_context(filename):
+    data = bytes(load_file(filename))
+    for (name, max_tables) in (("order-0", 1), ("order-1", MAX_CONTEXT_TABLES)):
+        start_time = time.perf_counter()
+        enc_bytes = encode_context(data, max_tables)
+        enc_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        assert decode_context(enc_bytes) == data
+        dec_time = time.perf_counter() - start_time
+        print("%s: %d bytes to %d bytes, encode %.3f s, decode %.3f s." %\
+              (name, len(data), len(enc_bytes), enc_time, dec_time))
+
+    for test_data in [b'', b'a', b'abababab', bytes(range(256)) * 4]:
+        assert decode_context(encode_context(test_data)) == test_data
+
+
+#-------------------------------------------------------------------
+# main()
+#-------------------------------------------------------------------
+def main():
+    test_context(sys.argv[1] if len(sys.argv) > 1 else __file__)
+    return 0
+
+
+#-------------------------------------------------------------------
+# __name__
+# Python thingy which allows the file to be run standalone as
+# well as parsed from within a Python interpreter.
+#-------------------------------------------------------------------
+if __name__=="__main__":
+    # Run the main function.
+    sys.exit(main())
+
+#=======================================================================
+# EOF huffman_context.py
+#=======================================================================
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#=======================================================================
+#
+# huffman_dict.py
+# ---------------
+# Pre-trained static Huffman code tables (dictionaries). A table
+# is trained once on a sample corpus and saved as a versioned
+# dictionary file. Messages are then encoded and decoded in a
+# single pass with only the dictionary id and message length in
+# front of the encoded bits. Bytes not seen during training are
+# coded using an escape code followed by the raw byte.
+#
+#
+# Author: Joachim Strömbergson
+# Copyright (c) 2014, Secworks Sweden AB
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#=======================================================================
+
+#-------------------------------------------------------------------
+# Python module imports.
+#-------------------------------------------------------------------
+import sys
+import argparse
+
+from prefix_tuple_tree import gen_node_list, gen_limited_code_lengths
+from prefix_tuple_tree import gen_canonical_codes, gen_decode_tables
+from prefix_tuple_tree import bitencode_bytes, decode_chunk
+from prefix_tuple_tree import load_file, save_file, NUM_SYMBOLS
+
+
+#-------------------------------------------------------------------
+# Constants.
+#-------------------------------------------------------------------
+VERBOSE = False
+
+DICT_MAGIC = b'HUFD'
+DICT_VERSION = 1
+
+# The escape symbol follows the byte symbols in the dictionary
+# alphabet.
+ESCAPE_SYMBOL = NUM_SYMBOLS
+DICT_SYMBOLS = NUM_SYMBOLS + 1
+
+# Limit for the code lengths in a dictionary. Keeps the escape
+# code, and so escaped bytes, reasonably short.
+DICT_MAX_CODE_LENGTH = 15
+
+# The escape symbol gets this share (1/2^n) of the sample weight
+# during training.
+DICT_ESCAPE_SHIFT = 12
+
+
+#-------------------------------------------------------------------
+# class Dictionary
+#
+# A trained code table with the given id. The dictionary is
+# stored as the code lengths for the bytes and the escape
+# symbol. The byte code tables used for encoding, where bytes
+# without a code of their own get the escape code followed by the
+# eight bits of the byte, and the decode tables are built once
+# when the dictionary is created.
+#-------------------------------------------------------------------
+class Dictionary:
+    def __init__(self, dict_id, len_table):
+        self.dict_id = dict_id
+        self.len_table = list(len_table)
+        (self.byte_code_table, self.byte_len_table) = gen_escaped_tables(self.len_table)
+        self.decode_tables = gen_decode_tables(self.byte_code_table,
+                                               self.byte_len_table)
+
+    def print_fields(self):
+        num_coded = sum(1 for length in self.len_table[:NUM_SYMBOLS] if length)
+        print("Dictionary id 0x%08x with %d coded bytes, escape length %d" %\
+              (self.dict_id, num_coded, self.len_table[ESCAPE_SYMBOL]))
+
+
+#-------------------------------------------------------------------
+# gen_escaped_tables()
+#
+# Given the code lengths for the dictionary alphabet, returns a
+# tuple (code_table, len_table) for the bytes. Bytes with a code
+# of their own use it, other bytes are coded as the escape code
+# followed by the byte. The resulting byte code is complete and
+# prefix free, so the normal encoder and decoder can be used.
+#-------------------------------------------------------------------
+def gen_escaped_tables(len_table):
+    code_table = gen_canonical_codes(len_table)
+    esc_code = code_table[ESCAPE_SYMBOL]
+    esc_len = len_table[ESCAPE_SYMBOL]
+
+    byte_code_table = [0] * NUM_SYMBOLS
+    byte_len_table = [0] * NUM_SYMBOLS
+    for char in range(NUM_SYMBOLS):
+        if len_table[char]:
+            byte_code_table[char] = code_table[char]
+            byte_len_table[char] = len_table[char]
+        else:
+            byte_code_table[char] = (esc_code << 8) | char
+            byte_len_table[char] = esc_len + 8
+
+    return (byte_code_table, byte_len_table)
+
+
+#-------------------------------------------------------------------
+# train_dictionary()
+#
+# Train a dictionary with the given id on the given list of
+# sample messages. The byte frequencies of all samples are
+# collected with gen_node_list() and an escape symbol is added.
+# The code lengths are limited to DICT_MAX_CODE_LENGTH bits.
+#-------------------------------------------------------------------
+def train_dictionary(samples, dict_id):
+    freq_list = [0] * DICT_SYMBOLS
+    for sample in samples:
+        for (char, weight, children, left, right) in gen_node_list(sample):
+            freq_list[char] += weight
+
+    freq_list[ESCAPE_SYMBOL] = max(1, sum(freq_list) >> DICT_ESCAPE_SHIFT)
+    nlist = [(char, freq_list[char], 0, None, None)
+             for char in range(DICT_SYMBOLS) if freq_list[char]]
+    len_table = gen_limited_code_lengths(nlist, DICT_MAX_CODE_LENGTH, DICT_SYMBOLS)
+
+    if VERBOSE:
+        print("Trained dictionary on %d bytes in %d samples." %\
+              (sum(freq_list[:NUM_SYMBOLS]), len(samples)))
+
+    return Dictionary(dict_id, len_table)
+
+
+#-------------------------------------------------------------------
+# save_dictionary()
+#
+# Save the dictionary to a file with the given name. The file
+# holds magic, version, the dictionary id (4 bytes) and the code
+# lengths for the dictionary alphabet.
+#-------------------------------------------------------------------
+def save_dictionary(filename, dictionary):
+    save_file(filename, DICT_MAGIC + bytes([DICT_VERSION]) +
+              dictionary.dict_id.to_bytes(4, 'big') + bytes(dictionary.len_table))
+
+
+#-------------------------------------------------------------------
+# load_dictionary()
+#
+# Load a dictionary saved by save_dictionary().
+#-------------------------------------------------------------------
+def load_dictionary(filename):
+    data = bytes(load_file(filename))
+    pos = len(DICT_MAGIC)
+    if len(data) != pos + 5 + DICT_SYMBOLS or data[0 : pos] != DICT_MAGIC:
+        raise ValueError("Not a Huffman dictionary file.")
+    if data[pos] != DICT_VERSION:
+        raise ValueError("Unsupported dictionary version %d." % data[pos])
+
+    dict_id = int.from_bytes(data[pos + 1 : pos + 5], 'big')
+    return Dictionary(dict_id, data[pos + 5 :])
+
+
+#-------------------------------------------------------------------
+# encode_varint()
+#
+# Returns the given unsigned integer as a LEB128 varint.
+#-------------------------------------------------------------------
+def encode_varint(value):
+    varint = bytearray()
+    while value >= 0x80:
+        varint.append((value & 0x7f) | 0x80)
+        value >>= 7
+    varint.append(value)
+    return bytes(varint)
+
+
+#-------------------------------------------------------------------
+# decode_varint()
+#
+# Decode a LEB128 varint at the given position in the data.
+# Returns a tuple (value, position after the varint).
+#-------------------------------------------------------------------
+def decode_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("Truncated varint.")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return (value, pos)
+        shift += 7
+
+
+#-------------------------------------------------------------------
+# encode_message()
+#
+# Encode the given message in a single pass using the given
+# dictionary. The encoded message is the dictionary id (4 bytes),
+# the message length as a varint and the encoded bits.
+#-------------------------------------------------------------------
+def encode_message(message, dictionary):
+    return dictionary.dict_id.to_bytes(4, 'big') + encode_varint(len(message)) +\
+        bitencode_bytes(message, dictionary.byte_code_table,
+                        dictionary.byte_len_table)
+
+
+#-------------------------------------------------------------------
+# decode_message()
+#
+# Decode a message encoded by encode_message(). The dictionary
+# is looked up by the id in the message in the given dict of
+# dictionaries keyed by id.
+#-------------------------------------------------------------------
+def decode_message(enc_message, dictionaries):
+    if len(enc_message) < 5:
+        raise ValueError("Truncated message.")
+
+    dict_id = int.from_bytes(enc_message[0 : 4], 'big')
+    if dict_id not in dictionaries:
+        raise ValueError("Unknown dictionary id 0x%08x." % dict_id)
+
+    (num_chars, pos) = decode_varint(enc_message, 4)
+    (dec_bytes, acc, acc_bits) = decode_chunk(memoryview(enc_message)[pos:],
+                                              dictionaries[dict_id].decode_tables,
+                                              num_chars, 0, 0)
+    if len(dec_bytes) < num_chars:
+        raise ValueError("Encoded message ended before %d chars were decoded."
+                         % num_chars)
+    return bytes(dec_bytes)
+
+
+#-------------------------------------------------------------------
+# test_dictionary()
+#
+# Train a dictionary on the lines of the first half of the given
+# file and encode and decode the lines of the second half. Prints
+# the size compared to the original lines.
+#-------------------------------------------------------------------
+def test_dictionary(filename):
+    lines = bytes(load_file(filename)).splitlines(True)
+    half = len(lines) // 2
+    dictionary = train_dictionary(lines[: half], 0x1234)
+    dictionary.print_fields()
+
+    dictionaries = {dictionary.dict_id : dictionary}
+    raw_bytes = 0
+    enc_bytes = 0
+    for line in lines[half :] + [bytes(range(256))]:
+        enc_message = encode_message(line, dictionary)
+        assert decode_message(enc_message, dictionaries) == line
+        raw_bytes += len(line)
+        enc_bytes += len(enc_message)
+
+    print("Encoded %d bytes in %d messages to %d bytes." %\
+          (raw_bytes, len(lines) - half + 1, enc_bytes))
+
+
+#-------------------------------------------------------------------
+# main()
+#
+# Train a dictionary from sample files, or encode or decode a
+# file as a single message using a dictionary.
+#-------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-t', '--train', nargs='+', metavar='SAMPLE',
+                        help='Train a dictionary on the given sample files.')
+
+    parser.add_argument('--id', type=lambda x: int(x, 0), default=1,
+                        help='The id of the trained dictionary.')
+
+    parser.add_argument('-D', '--dictionary', required=True,
+                        help='The dictionary file.')
+
+    parser.add_argument('-i', '--infile',
+                        help='The input file to be encoded or decoded.')
+
+    parser.add_argument('-o', '--outfile',
+                        help='The output file the processed data will be saved to.')
+
+    parser.add_argument('-d', '--decode', action='store_true',
+                        help='Perform decoding instead of encoding.')
+
+    args = parser.parse_args()
+
+    if args.train:
+        samples = [load_file(sample) for sample in args.train]
+        save_dictionary(args.dictionary, train_dictionary(samples, args.id))
+        return 0
+
+    if args.infile == None or args.outfile == None:
+        print("Error: Input and output files are needed.")
+        return 1
+
+    dictionary = load_dictionary(args.dictionary)
+    data = load_file(args.infile)
+    if args.decode:
+        save_file(args.outfile, decode_message(data, {dictionary.dict_id : dictionary}))
+    else:
+        save_file(args.outfile, encode_message(data, dictionary))
+    return 0
+
+
+#-------------------------------------------------------------------
+# __name__
+# Python thingy which allows the file to be run standalone as
+# well as parsed from within a Python interpreter.
+#-------------------------------------------------------------------
+if __name__=="__main__":
+    # Run the main function.
+    sys.exit(main())
+
+#=======================================================================
+# EOF huffman_dict.py
+#=======================================================================
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#=======================================================================
+#
+# huffman_tokens.py
+# -----------------
+# Huffman coding over symbol alphabets larger than bytes. A
+# tokenizer splits the data into tokens (16 bit units, words and
+# so on) and an alphabet of up to MAX_SYMBOLS symbols is built
+# from the most common tokens. The bytes are always part of the
+# alphabet, so tokens not in it are coded as their bytes.
+#
+#
+# Author: Joachim Strömbergson
+# Copyright (c) 2014, Secworks Sweden AB
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or
+# without modification, are permitted provided that the following
+# conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in
+#    the documentation and/or other materials provided with the
+#    distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF
+# ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+#=======================================================================
+
+#-------------------------------------------------------------------
+# Python module imports.
+#-------------------------------------------------------------------
+import re
+import sys
+import math
+import time
+from array import array
+from collections import Counter
+
+from huffman_dict import encode_varint, decode_varint
+from prefix_tuple_tree import gen_histogram_canonical_codes, gen_canonical_codes
+from prefix_tuple_tree import gen_decode_tables
+from prefix_tuple_tree import pack_code_lengths, unpack_code_lengths
+from prefix_tuple_tree import bitencode_chunk, decode_chunk, flush_bits
+from prefix_tuple_tree import load_file, NUM_SYMBOLS
+
+
+#-------------------------------------------------------------------
+# Constants.
+#-------------------------------------------------------------------
+VERBOSE = False
+
+TOKEN_MAGIC = b'HUFT'
+TOKEN_VERSION = 2
+
+MAX_SYMBOLS = 1 << 20
+
+# Code length limit and primary lookup table size used for large
+# alphabets. With up to 2^20 symbols the limit leaves room for
+# skewed distributions, while keeping the secondary decode tables
+# at most 2^8 entries each.
+TOKEN_MAX_CODE_LENGTH = 24
+TOKEN_LOOKUP_BITS = 16
+
+# Tokens must occur at least this many times to get a symbol.
+MIN_TOKEN_COUNT = 2
+
+WORD_PATTERN = re.compile(rb'\w+|\s+|[^\w\s]+')
+
+
+#-------------------------------------------------------------------
+# split_bytes()
+# split_units()
+# split_words()
+#
+# The tokenizers. A tokenizer is any function that takes the
+# data and returns a list of byte string tokens that concatenate
+# back to the data. split_bytes() gives the normal byte
+# alphabet, split_units() 16 bit units and split_words() runs of
+# word chars, white space and other chars.
+#-------------------------------------------------------------------
+def split_bytes(data):
+    return [data[i : i + 1] for i in range(len(data))]
+
+
+def split_units(data):
+    return [data[i : i + 2] for i in range(0, len(data), 2)]
+
+
+def split_words(data):
+    return WORD_PATTERN.findall(data)
+
+
+TOKENIZERS = {'byte' : split_bytes, 'u16' : split_units, 'word' : split_words}
+
+
+#-------------------------------------------------------------------
+# gen_alphabet()
+#
+# Given a list of tokens returns the alphabet as a list with the
+# token for each symbol. The first NUM_SYMBOLS symbols are the
+# single bytes, followed by the multi byte tokens worth a symbol
+# of their own, most common first, up to a total of max_symbols
+# symbols.
+#
+# A token is worth a symbol if the estimated bits saved by coding
+# it as one symbol instead of as its bytes is more than the cost
+# of storing the token in the header. The estimates use the
+# order-0 entropy of the bytes and of the tokens.
+#-------------------------------------------------------------------
+def gen_alphabet(tokens, max_symbols = MAX_SYMBOLS):
+    if max_symbols > MAX_SYMBOLS:
+        raise ValueError("At most %d symbols are supported." % MAX_SYMBOLS)
+
+    token_counts = Counter(tokens)
+    byte_counts = [0] * NUM_SYMBOLS
+    for (token, count) in token_counts.items():
+        for char in token:
+            byte_counts[char] += count
+    total_bytes = sum(byte_counts)
+    byte_bits = [math.log2(total_bytes / count) if count else 0
+                 for count in byte_counts]
+
+    multi_tokens = []
+    total_tokens = len(tokens)
+    for (token, count) in token_counts.items():
+        if len(token) > 1 and count >= MIN_TOKEN_COUNT:
+            saved_bits = count * (sum(map(byte_bits.__getitem__, token)) -
+                                  math.log2(total_tokens / count))
+            if saved_bits > 8 * (len(token) + 2):
+                multi_tokens.append(token)
+    multi_tokens.sort(key=lambda token: (-token_counts[token], token))
+
+    alphabet = [bytes([i]) for i in range(NUM_SYMBOLS)]
+    return alphabet + multi_tokens[: max(0, max_symbols - NUM_SYMBOLS)]
+
+
+#-------------------------------------------------------------------
+# gen_symbols()
+#
+# Map the list of tokens to an array of symbols using the given
+# alphabet. Tokens not in the alphabet are mapped to the symbols
+# for their bytes.
+#-------------------------------------------------------------------
+def gen_symbols(tokens, alphabet):
+    index = {token : sym for (sym, token) in enumerate(alphabet)}
+    get_symbol = index.get
+    symbols = array('I')
+    for token in tokens:
+        sym = get_symbol(token)
+        if sym == None:
+            symbols.extend(token)
+        else:
+            symbols.append(sym)
+    return symbols
+
+
+#-------------------------------------------------------------------
+# encode_tokens()
+#
+# Encode the data using the given tokenizer and an alphabet of at
+# most max_symbols symbols. The encoded data holds magic,
+# version, the multi byte tokens of the alphabet, the packed code
+# lengths for all symbols, the number of symbols and the encoded
+# bits.
+#-------------------------------------------------------------------
+def encode_tokens(data, tokenizer = split_words, max_symbols = MAX_SYMBOLS):
+    data = bytes(data)
+    tokens = tokenizer(data)
+    alphabet = gen_alphabet(tokens, max_symbols)
+    symbols = gen_symbols(tokens, alphabet)
+
+    freq_list = [0] * len(alphabet)
+    for sym in symbols:
+        freq_list[sym] += 1
+
+    if symbols:
+        (code_table, len_table) = gen_histogram_canonical_codes(freq_list,
+                                                                TOKEN_MAX_CODE_LENGTH)
+    else:
+        (code_table, len_table) = ([0] * len(alphabet), [0] * len(alphabet))
+
+    enc_bytes = bytearray(TOKEN_MAGIC)
+    enc_bytes.append(TOKEN_VERSION)
+    enc_bytes += encode_varint(len(alphabet) - NUM_SYMBOLS)
+    for token in alphabet[NUM_SYMBOLS :]:
+        enc_bytes += encode_varint(len(token))
+        enc_bytes += token
+    enc_bytes += pack_code_lengths(len_table)
+    enc_bytes += encode_varint(len(symbols))
+
+    (dst_bytes, acc, acc_bits) = bitencode_chunk(symbols, code_table, len_table, 0, 0)
+    enc_bytes += dst_bytes
+    enc_bytes += flush_bits(acc, acc_bits)
+
+    if VERBOSE:
+        print("Coded %d bytes as %d symbols from an alphabet of %d." %\
+              (len(data), len(symbols), len(alphabet)))
+    return enc_bytes
+
+
+#-------------------------------------------------------------------
+# decode_tokens()
+#
+# Decode data encoded by encode_tokens().
+#-------------------------------------------------------------------
+def decode_tokens(enc_bytes):
+    enc_bytes = memoryview(enc_bytes).cast('B')
+    pos = len(TOKEN_MAGIC)
+    if bytes(enc_bytes[: pos]) != TOKEN_MAGIC:
+        raise ValueError("Not a Huffman token file.")
+    if enc_bytes[pos] != TOKEN_VERSION:
+        raise ValueError("Unsupported token file version %d." % enc_bytes[pos])
+
+    alphabet = [bytes([i]) for i in range(NUM_SYMBOLS)]
+    (num_tokens, pos) = decode_varint(enc_bytes, pos + 1)
+    for i in range(num_tokens):
+        (length, pos) = decode_varint(enc_bytes, pos)
+        alphabet.append(bytes(enc_bytes[pos : pos + length]))
+        pos += length
+
+    (len_table, pos) = unpack_code_lengths(enc_bytes, len(alphabet), pos)
+    (num_symbols, pos) = decode_varint(enc_bytes, pos)
+    if not num_symbols:
+        return b''
+
+    decode_tables = gen_decode_tables(gen_canonical_codes(len_table), len_table,
+                                      TOKEN_LOOKUP_BITS)
+    (symbols, acc, acc_bits) = decode_chunk(enc_bytes[pos :], decode_tables,
+                                            num_symbols, 0, 0, True)
+    if len(symbols) < num_symbols:
+        raise ValueError("Encoded data ended before %d symbols were decoded."
+                         % num_symbols)
+    return b''.join(map(alphabet.__getitem__, symbols))
+
+
+#-------------------------------------------------------------------
+# test_tokens()
+#
+# Encode and decode the given file with each tokenizer and print
+# the size and time compared to the byte alphabet.
+#-------------------------------------------------------------------
+def test_tokens(filename):
+    data = bytes(load_file(filename))
+    for name in TOKENIZERS:
+        start_time = time.perf_counter()
+        enc_bytes = encode_tokens(data, TOKENIZERS[name])
+        enc_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        assert decode_tokens(enc_bytes) == data
+        dec_time = time.perf_counter() - start_time
+        print("%-5s %d bytes to %d bytes, encode %.3f s, decode %.3f s." %\
+              (name, len(data), len(enc_bytes), enc_time, dec_time))
+
+    for data in [b'', b'a', b'ab ab ab', bytes(range(256))]:
+        for name in TOKENIZERS:
+            assert decode_tokens(encode_tokens(data, TOKENIZERS[name])) == data
+
+
+#-------------------------------------------------------------------
+# main()
+#-------------------------------------------------------------------
+def main():
+    test_tokens(sys.argv[1] if len(sys.argv) > 1 else __file__)
+    return 0
+
+
+#-------------------------------------------------------------------
+# __name__
+# Python thingy which allows the file to be run standalone as
+# well as parsed from within a Python interpreter.
+#-------------------------------------------------------------------
+if __name__=="__main__":
+    # Run the main function.
+    sys.exit(main())
+
+#=======================================================================
+# EOF huffman_tokens.py
+#=======================================================================
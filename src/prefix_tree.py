@@ -43,7 +43,9 @@
 # Python module imports.
 #-------------------------------------------------------------------
 import sys
+import heapq
 import random
+from collections import deque
 
 
 #-------------------------------------------------------------------
@@ -55,9 +57,12 @@ VERBOSE = False
 #-------------------------------------------------------------------
 # class Node
 #
-# Our basic node class (struct) used to create the tree.
+# Our basic node class (struct) used to create the tree. Uses
+# slots so that nodes do not carry a per instance dict.
 #-------------------------------------------------------------------
 class Node:
+    __slots__ = ('char', 'weight', 'lchild', 'rchild', 'children')
+
     def __init__(self, char, weight):
         self.char = char
         self.weight = weight
@@ -127,27 +132,83 @@ def extract_prefix_codes(ptree):
 #
 # Given a list of tuples with frequency (weight) for a character
 # the function returns the corresponding tuple based prefix tree.
+#
+# The two nodes with least weight are found using a heap, which
+# makes building the tree O(n log n). If the list is already
+# sorted by weight in decreasing order (as returned by
+# sort_node_list()) the linear time two queue builder is used.
 #-------------------------------------------------------------------
 def gen_prefix_tree(nlist):
-    while (len(nlist) > 1):
-        if VERBOSE:
-            print("Length of prefix list: %d" % len(nlist))
+    if is_sorted_node_list(nlist):
+        return gen_sorted_prefix_tree(nlist)
 
-        nlist = sort_node_list(nlist)
-        node1 = nlist.pop()
-        node2 = nlist.pop()
+    heap = [(node.weight, i, node) for (i, node) in enumerate(nlist)]
+    heapq.heapify(heap)
+    seq = len(heap)
+
+    while (len(heap) > 1):
+        (weight1, i1, node1) = heapq.heappop(heap)
+        (weight2, i2, node2) = heapq.heappop(heap)
+
+        new_node = Node(None, (weight1 + weight2))
+        new_node.lchild = node1
+        new_node.rchild = node2
+        new_node.children = 2 + node1.children + node2.children
+        heapq.heappush(heap, (new_node.weight, seq, new_node))
+        seq += 1
+
+    return heap[0][2]
 
-        if VERBOSE:
-            print("node1 weigth: %d" % node1.weight)
-            print("node2 weigth: %d" % node2.weight)
 
+#-------------------------------------------------------------------
+# gen_sorted_prefix_tree()
+#
+# Given a list of nodes sorted by weight in decreasing order
+# returns the corresponding prefix tree. The tree is built in
+# linear time using two queues, one with the leaves and one
+# with the merged nodes. Since merged nodes are created in
+# increasing weight order, the two nodes with least weight are
+# always found at the head of the queues.
+#-------------------------------------------------------------------
+def gen_sorted_prefix_tree(nlist):
+    leaves = nlist[::-1]
+    num_leaves = len(leaves)
+    leaf_idx = 0
+    merged = deque()
+
+    while ((num_leaves - leaf_idx) + len(merged) > 1):
+        pair = []
+        for i in range(2):
+            if leaf_idx < num_leaves and\
+               (not merged or leaves[leaf_idx].weight <= merged[0].weight):
+                pair.append(leaves[leaf_idx])
+                leaf_idx += 1
+            else:
+                pair.append(merged.popleft())
+
+        (node1, node2) = pair
         new_node = Node(None, (node1.weight + node2.weight))
         new_node.lchild = node1
         new_node.rchild = node2
         new_node.children = 2 + node1.children + node2.children
-        nlist.append(new_node)
+        merged.append(new_node)
+
+    if merged:
+        return merged.pop()
+    return leaves[leaf_idx]
+
 
-    return nlist.pop()
+#-------------------------------------------------------------------
+# is_sorted_node_list()
+#
+# Returns True if the given list of nodes is sorted by weight
+# in decreasing order.
+#-------------------------------------------------------------------
+def is_sorted_node_list(nlist):
+    for i in range(1, len(nlist)):
+        if nlist[i - 1].weight < nlist[i].weight:
+            return False
+    return True
 
 
 #-------------------------------------------------------------------
@@ -157,22 +218,9 @@ def gen_prefix_tree(nlist):
 # sorted by weight in decreasing order.
 #-------------------------------------------------------------------
 def sort_node_list(nlist):
-    nodes = 0
-    new_list = []
     if VERBOSE:
         print("Length of given list: %d" % len(nlist))
-    for i in range(len(nlist)):
-        node = nlist.pop()
-        nodes += 1
-        if len(new_list) == 0:
-            new_list.append(node)
-        else:
-            i = 0
-            while ((i < len(new_list) and (node.weight < new_list[i].weight))):
-                i += 1
-            new_list = new_list[:i] + [node] + new_list[i:]
-
-    return new_list
+    return sorted(nlist, key=lambda node: node.weight, reverse=True)
 
 
 #-------------------------------------------------------------------
@@ -42,9 +42,25 @@
 #-------------------------------------------------------------------
 # Python module imports.
 #-------------------------------------------------------------------
+import os
 import sys
+import mmap
+import time
+import math
+import heapq
 import random
 import binascii
+import threading
+import tracemalloc
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from collections import deque, Counter, OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 #-------------------------------------------------------------------
@@ -53,50 +69,195 @@ import binascii
 VERBOSE = False
 DUMP_FREQS = False
 
+# Callable called as METRICS_SINK(stage, metrics) after each
+# instrumented stage, or None to disable instrumentation. See
+# set_metrics_sink().
+METRICS_SINK = None
+
+NUM_SYMBOLS = 256
+LOOKUP_BITS = 11
+SUB_LOOKUP_BITS = 8
+CHUNK_SIZE = 1 << 20
+
+# Histograms with more than LIMIT_MERGE_MAX_SYMBOLS coded chars
+# are length limited with gen_clamped_code_lengths(), as the
+# package-merge takes too long and too much memory for them.
+LIMIT_MERGE_MAX_SYMBOLS = 1 << 12
+
+CACHE_SIZE = 64
+CACHE_COST_MARGIN = 0.01
+CACHE_QUANT_BITS = 8
+CACHE_SCAN = 4
+
+# The NumPy encoder is used for chunks of at least NUMPY_MIN_SIZE
+# chars and encodes NUMPY_CHUNK_SIZE chars at a time, with codes
+# of at most NUMPY_MAX_CODE_LENGTH bits.
+NUMPY_MIN_SIZE = 1 << 12
+NUMPY_CHUNK_SIZE = 1 << 20
+NUMPY_MAX_CODE_LENGTH = 63
+
+# Code length code alphabet used by pack_code_lengths() and the
+# order its code lengths are stored in, most likely used first.
+CL_SYMBOLS = 20
+CL_MAX_CODE_LENGTH = 7
+CL_ORDER = [16, 17, 18, 0, 8, 7, 9, 6, 10, 5, 11, 4, 12, 3, 13, 2, 14, 1, 15, 19]
+
+# Default number of sub-streams each block is split into by
+# encode_streams(), and the size of each jump table entry. The
+# default is above NUMPY_MIN_LANES so that the NumPy lane decoder
+# is used; with fewer lanes its loop overhead outweighs the gain.
+NUM_STREAMS = 64
+MAX_STREAMS = 255
+JUMP_ENTRY_SIZE = 4
+
+# The NumPy lane decoder is used for at least NUMPY_MIN_LANES
+# sub-streams with codes of at most NUMPY_MAX_LANE_BITS bits.
+NUMPY_MIN_LANES = 16
+NUMPY_MAX_LANE_BITS = 16
+
+
+#-------------------------------------------------------------------
+# set_metrics_sink()
+#
+# Set the callable that gets the metrics from the instrumented
+# stages, or None to disable instrumentation. The sink is called
+# as sink(stage, metrics) where metrics is a dict with the time
+# spent in 'seconds' and stage specific counters:
+#
+#   histogram     bytes
+#   tree          symbols
+#   codes         symbols, max_len
+#   decode_tables tables, entries
+#   encode        bytes_in, bytes_out
+#   decode        bytes_in, bytes_out
+#
+# When no sink is set, each instrumented function only pays for
+# one test per call, never per byte. Returns the previous sink.
+#-------------------------------------------------------------------
+def set_metrics_sink(sink):
+    global METRICS_SINK
+    old_sink = METRICS_SINK
+    METRICS_SINK = sink
+    return old_sink
+
+
+#-------------------------------------------------------------------
+# get_metrics_sink()
+#
+# Returns the current metrics sink, or None.
+#-------------------------------------------------------------------
+def get_metrics_sink():
+    return METRICS_SINK
+
+
+#-------------------------------------------------------------------
+# emit_metrics()
+#
+# Call the given metrics sink for the given stage that started
+# at start_time. Only called when a sink is set.
+#-------------------------------------------------------------------
+def emit_metrics(sink, stage, start_time, **metrics):
+    metrics['seconds'] = time.perf_counter() - start_time
+    sink(stage, metrics)
+
+
+#-------------------------------------------------------------------
+# class MetricsCollector
+#
+# Metrics sink that sums the metrics for each stage and counts
+# the number of calls. Can be given to set_metrics_sink().
+#-------------------------------------------------------------------
+class MetricsCollector:
+    def __init__(self):
+        self.stages = {}
+
+    def __call__(self, stage, metrics):
+        counters = self.stages.setdefault(stage, {'calls' : 0})
+        counters['calls'] += 1
+        for name in metrics:
+            if name == 'max_len':
+                counters[name] = max(counters.get(name, 0), metrics[name])
+            else:
+                counters[name] = counters.get(name, 0) + metrics[name]
+
+    def print_fields(self):
+        for stage in sorted(self.stages):
+            counters = self.stages[stage]
+            fields = ", ".join("%s = %s" % (name, counters[name])
+                               for name in sorted(counters))
+            print("Stage %s: %s" % (stage, fields))
+            num_bytes = counters.get('bytes', counters.get('bytes_in', 0))
+            if num_bytes and counters['seconds'] > 0:
+                print("Stage %s: %.2f MB/s" %\
+                      (stage, num_bytes / (1024 * 1024) / counters['seconds']))
+
 
 #-------------------------------------------------------------------
-# Given a file name will try to load the contents of the file
-# into a string.
+# print_metrics()
+#
+# Metrics sink that prints the metrics for each stage.
+#-------------------------------------------------------------------
+def print_metrics(stage, metrics):
+    fields = ", ".join("%s = %s" % (name, metrics[name]) for name in sorted(metrics))
+    print("Stage %s: %s" % (stage, fields))
+
+
+#-------------------------------------------------------------------
+# load_file()
+#
+# Given a file name will map the contents of the file into
+# memory and return it as a read only memoryview. No copy of the
+# file data is made, the pages are read by the OS as they are
+# accessed.
 #-------------------------------------------------------------------
 def load_file(filename):
     with open (filename, 'rb') as f:
-        file_data = f.read()
-    return file_data
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b'')
+        file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(file_map)
 
 
 #-------------------------------------------------------------------
 # save_file()
 #
-# Save the given string to a file with the given name.
+# Save the given data to a file with the given name. The data
+# can be any bytes-like object, or a string with one char per
+# byte as returned by gen_bytestring(). The data is handed to
+# the file in one block.
 #-------------------------------------------------------------------
 def save_file(filename, bytestring):
+    if isinstance(bytestring, str):
+        bytestring = bytestring.encode('latin-1')
     with open (filename, 'wb') as f:
-        for ch in bytestring:
-            f.write(ch.encode('latin-1'))
+        f.write(bytestring)
+
 
 #-------------------------------------------------------------------
 # get_node_codes()
 #
 # Get a list of tuples with the prefix codes for a char in a
-# given node as well as for its subnodes.
+# given node as well as for its subnodes. The tree is walked
+# with an explicit stack so that deep, skewed trees do not hit
+# the recursion limit or copy lists at every level.
 #-------------------------------------------------------------------
 def get_node_codes(prefix, ptree):
-    (char, weight, children, left_tree, right_tree) = ptree
-
-    if char == None:
-        left_list = []
-        right_list = []
+    code_list = []
+    stack = [(prefix, ptree)]
 
-        if left_tree != None:
-          left_list = get_node_codes(prefix + '0', left_tree)
+    while stack:
+        (prefix, (char, weight, children, left_tree, right_tree)) = stack.pop()
+        if char == None:
+            if right_tree != None:
+                stack.append((prefix + '1', right_tree))
 
-        if right_tree != None:
-          right_list = get_node_codes(prefix + '1', right_tree)
+            if left_tree != None:
+                stack.append((prefix + '0', left_tree))
 
-        return left_list + right_list
+        else:
+            code_list.append((char, weight, prefix))
 
-    else:
-        return [(char, weight, prefix)]
+    return code_list
 
 
 #-------------------------------------------------------------------
@@ -122,31 +283,754 @@ def extract_prefix_codes(ptree):
     return prefix_dict
 
 
+#-------------------------------------------------------------------
+# get_code_lengths()
+#
+# Given a prefix tree returns a list with the code length for
+# each of the num_symbols possible chars. Chars not in the tree
+# get length zero. A tree with a single leaf gives that char
+# length one so that it can still be encoded.
+#-------------------------------------------------------------------
+def get_code_lengths(ptree, num_symbols = NUM_SYMBOLS):
+    len_table = [0] * num_symbols
+
+    if ptree[0] != None:
+        len_table[ptree[0]] = 1
+        return len_table
+
+    stack = [(ptree, 0)]
+    while stack:
+        ((char, weight, children, left_tree, right_tree), depth) = stack.pop()
+        if char != None:
+            len_table[char] = depth
+        else:
+            if left_tree != None:
+                stack.append((left_tree, depth + 1))
+            if right_tree != None:
+                stack.append((right_tree, depth + 1))
+
+    return len_table
+
+
+#-------------------------------------------------------------------
+# gen_inplace_code_lengths()
+#
+# Given a list of weights sorted in increasing order, replaces
+# each weight with its Huffman code length. The lengths are
+# computed in place without building a tree, using the algorithm
+# by Moffat and Katajainen:
+#
+# 1. Build the tree bottom up with the two queue method, where
+#    each merged node is stored over the weight it consumed and
+#    its children are given the index of their parent.
+# 2. Walk the inner nodes from the root down, replacing each
+#    parent index with the depth of the node.
+# 3. Count the inner nodes at each depth to find the number of
+#    leaves at each depth, and assign these depths to the
+#    weights from the largest down.
+#-------------------------------------------------------------------
+def gen_inplace_code_lengths(weights):
+    n = len(weights)
+    if n < 2:
+        if n == 1:
+            weights[0] = 1
+        return weights
+
+    weights[0] += weights[1]
+    root = 0
+    leaf = 2
+    for next_node in range(1, n - 1):
+        if leaf >= n or weights[root] < weights[leaf]:
+            weights[next_node] = weights[root]
+            weights[root] = next_node
+            root += 1
+        else:
+            weights[next_node] = weights[leaf]
+            leaf += 1
+
+        if leaf >= n or (root < next_node and weights[root] < weights[leaf]):
+            weights[next_node] += weights[root]
+            weights[root] = next_node
+            root += 1
+        else:
+            weights[next_node] += weights[leaf]
+            leaf += 1
+
+    weights[n - 2] = 0
+    for next_node in range(n - 3, -1, -1):
+        weights[next_node] = weights[weights[next_node]] + 1
+
+    avail = 1
+    used = 0
+    depth = 0
+    root = n - 2
+    next_node = n - 1
+    while avail > 0:
+        while root >= 0 and weights[root] == depth:
+            used += 1
+            root -= 1
+        while avail > used:
+            weights[next_node] = depth
+            next_node -= 1
+            avail -= 1
+        avail = 2 * used
+        depth += 1
+        used = 0
+
+    return weights
+
+
+#-------------------------------------------------------------------
+# gen_histogram_code_lengths()
+#
+# Given a list of frequencies indexed by char returns a list
+# with the code length for each char, computed directly from the
+# frequencies with gen_inplace_code_lengths(). Chars with zero
+# frequency get length zero.
+#-------------------------------------------------------------------
+def gen_histogram_code_lengths(freq_list):
+    chars = sorted((char for char in range(len(freq_list)) if freq_list[char]),
+                   key=freq_list.__getitem__)
+    lengths = gen_inplace_code_lengths([freq_list[char] for char in chars])
+
+    len_table = [0] * len(freq_list)
+    for (char, length) in zip(chars, lengths):
+        len_table[char] = length
+    return len_table
+
+
+#-------------------------------------------------------------------
+# gen_histogram_canonical_codes()
+#
+# Given a list of frequencies indexed by char returns a tuple
+# (code_table, len_table) with the canonical codes, like
+# extract_canonical_codes() but without building a tree. If
+# max_code_length is given and exceeded the lengths are instead
+# computed with gen_limited_code_lengths(), or clamped with
+# gen_clamped_code_lengths() for large alphabets.
+#-------------------------------------------------------------------
+def gen_histogram_canonical_codes(freq_list, max_code_length = None):
+    sink = METRICS_SINK
+    if sink != None:
+        start_time = time.perf_counter()
+
+    len_table = gen_histogram_code_lengths(freq_list)
+    if max_code_length != None and max(len_table) > max_code_length:
+        if len(freq_list) - len_table.count(0) > LIMIT_MERGE_MAX_SYMBOLS:
+            len_table = gen_clamped_code_lengths(len_table, max_code_length)
+        else:
+            len_table = gen_limited_code_lengths(gen_histogram_node_list(freq_list),
+                                                 max_code_length, len(freq_list))
+    code_table = gen_canonical_codes(len_table)
+
+    if sink != None:
+        emit_metrics(sink, 'codes', start_time,
+                     symbols=sum(1 for length in len_table if length),
+                     max_len=max(len_table))
+    return (code_table, len_table)
+
+
+#-------------------------------------------------------------------
+# gen_canonical_codes()
+#
+# Given a list of code lengths indexed by char returns a list
+# with the canonical Huffman code for each char. Codes are
+# integers with the first bit to emit as the most significant
+# of the len_table[char] bits. Codes are assigned in order of
+# increasing length, and chars with the same length get
+# consecutive codes in increasing char order. This means that
+# the code table can be rebuilt from the lengths alone.
+#-------------------------------------------------------------------
+def gen_canonical_codes(len_table):
+    max_len = max(len_table) if len_table else 0
+    bl_count = [0] * (max_len + 1)
+    for length in len_table:
+        bl_count[length] += 1
+    bl_count[0] = 0
+
+    next_code = [0] * (max_len + 2)
+    code = 0
+    for length in range(1, max_len + 1):
+        code = (code + bl_count[length - 1]) << 1
+        next_code[length] = code
+
+    code_table = [0] * len(len_table)
+    for char in range(len(len_table)):
+        length = len_table[char]
+        if length:
+            code_table[char] = next_code[length]
+            next_code[length] += 1
+
+    return code_table
+
+
+#-------------------------------------------------------------------
+# pack_code_lengths()
+#
+# Returns the given code lengths packed into a compact header in
+# the same way as the code length codes in DEFLATE. The lengths
+# are run length coded using the code length alphabet:
+#
+#   0 - 15  literal code length
+#   16      repeat the previous length 3 - 6 times (2 extra bits)
+#   17      repeat zero 3 - 10 times (3 extra bits)
+#   18      repeat zero 11 - 138 times (7 extra bits)
+#   19      literal code length 16 - 271 (8 extra bits)
+#
+# The run length symbols are Huffman coded with codes of at most
+# 7 bits. The header starts with the number of code length code
+# lengths stored (5 bits, minus 4) and the code length code
+# lengths (3 bits each) in CL_ORDER, with trailing zeros left out.
+# Then follow the coded run length symbols, padded to a byte.
+# The number of code lengths is not stored. Whole bytes are
+# flushed from the bit accumulator as in bitencode_chunk(), so the
+# time grows linearly with the number of lengths.
+#-------------------------------------------------------------------
+def pack_code_lengths(len_table):
+    rle_list = []
+    num_lengths = len(len_table)
+    i = 0
+    while i < num_lengths:
+        length = len_table[i]
+        run = 1
+        while i + run < num_lengths and len_table[i + run] == length:
+            run += 1
+
+        if length == 0 and run >= 3:
+            while run >= 11:
+                rep = min(run, 138)
+                rle_list.append((18, 7, rep - 11))
+                run -= rep
+                i += rep
+            if run >= 3:
+                rle_list.append((17, 3, run - 3))
+                i += run
+                run = 0
+        elif length != 0 and run >= 4:
+            rle_list.append(gen_length_literal(length))
+            run -= 1
+            i += 1
+            while run >= 3:
+                rep = min(run, 6)
+                rle_list.append((16, 2, rep - 3))
+                run -= rep
+                i += rep
+
+        for j in range(run):
+            rle_list.append(gen_length_literal(length))
+        i += run
+
+    cl_freqs = [0] * CL_SYMBOLS
+    for (sym, extra_bits, extra) in rle_list:
+        cl_freqs[sym] += 1
+    if rle_list:
+        (cl_codes, cl_lens) = gen_histogram_canonical_codes(cl_freqs, CL_MAX_CODE_LENGTH)
+    else:
+        (cl_codes, cl_lens) = ([0] * CL_SYMBOLS, [0] * CL_SYMBOLS)
+
+    num_cl = CL_SYMBOLS
+    while num_cl > 4 and cl_lens[CL_ORDER[num_cl - 1]] == 0:
+        num_cl -= 1
+
+    dst_bytes = bytearray()
+    acc = num_cl - 4
+    acc_bits = 5
+    for i in range(num_cl):
+        acc = (acc << 3) | cl_lens[CL_ORDER[i]]
+        acc_bits += 3
+    for (sym, extra_bits, extra) in rle_list:
+        acc = (((acc << cl_lens[sym]) | cl_codes[sym]) << extra_bits) | extra
+        acc_bits += cl_lens[sym] + extra_bits
+        if acc_bits >= 32:
+            num_bytes = acc_bits >> 3
+            acc_bits &= 7
+            dst_bytes += (acc >> acc_bits).to_bytes(num_bytes, 'big')
+            acc &= (1 << acc_bits) - 1
+
+    dst_bytes += flush_bits(acc, acc_bits)
+    return bytes(dst_bytes)
+
+
+#-------------------------------------------------------------------
+# gen_length_literal()
+#
+# Returns the run length symbol tuple (sym, extra_bits, extra)
+# for a literal code length. Raises ValueError for lengths that
+# can not be coded, i.e. longer than 271 bits.
+#-------------------------------------------------------------------
+def gen_length_literal(length):
+    if length < 16:
+        return (length, 0, 0)
+    if length > 271:
+        raise ValueError("Code length %d can not be packed." % length)
+    return (19, 8, length - 16)
+
+
+#-------------------------------------------------------------------
+# unpack_code_lengths()
+#
+# Unpack num_lengths code lengths packed by pack_code_lengths()
+# from the given bytes-like object, starting at byte offset pos.
+# Returns a tuple (len_table, pos) with pos the byte offset
+# after the packed lengths. Raises ValueError if the data is
+# truncated or invalid.
+#-------------------------------------------------------------------
+def unpack_code_lengths(src_bytes, num_lengths, pos = 0):
+    src_bytes = memoryview(src_bytes).cast('B')
+    bit_pos = pos * 8
+    end_bit = len(src_bytes) * 8
+
+    def read_bits(num_bits):
+        nonlocal bit_pos
+        if bit_pos + num_bits > end_bit:
+            raise ValueError("Truncated code length header.")
+        first = bit_pos >> 3
+        last = (bit_pos + num_bits + 7) >> 3
+        value = int.from_bytes(src_bytes[first : last], 'big')
+        value >>= last * 8 - bit_pos - num_bits
+        bit_pos += num_bits
+        return value & ((1 << num_bits) - 1)
+
+    num_cl = read_bits(5) + 4
+    if num_cl > CL_SYMBOLS:
+        raise ValueError("Invalid code length header.")
+    cl_lens = [0] * CL_SYMBOLS
+    for i in range(num_cl):
+        cl_lens[CL_ORDER[i]] = read_bits(3)
+    cl_codes = gen_canonical_codes(cl_lens)
+    cl_lookup = {(cl_lens[sym], cl_codes[sym]) : sym
+                 for sym in range(CL_SYMBOLS) if cl_lens[sym]}
+
+    len_table = []
+    while len(len_table) < num_lengths:
+        code = 0
+        code_len = 0
+        while (code_len, code) not in cl_lookup:
+            if code_len == CL_MAX_CODE_LENGTH:
+                raise ValueError("Invalid code length header.")
+            code = (code << 1) | read_bits(1)
+            code_len += 1
+        sym = cl_lookup[(code_len, code)]
+
+        if sym < 16:
+            len_table.append(sym)
+        elif sym == 16:
+            if not len_table:
+                raise ValueError("Invalid code length header.")
+            len_table += [len_table[-1]] * (read_bits(2) + 3)
+        elif sym == 17:
+            len_table += [0] * (read_bits(3) + 3)
+        elif sym == 18:
+            len_table += [0] * (read_bits(7) + 11)
+        else:
+            len_table.append(read_bits(8) + 16)
+
+    if len(len_table) != num_lengths:
+        raise ValueError("Invalid code length header.")
+    return (len_table, (bit_pos + 7) >> 3)
+
+
+#-------------------------------------------------------------------
+# extract_canonical_codes()
+#
+# Given a prefix tree returns a tuple (code_table, len_table)
+# with the canonical codes and code lengths for all chars.
+#
+# If max_code_length is given and the tree has codes longer than
+# that, the lengths are instead computed from the weights of the
+# leaves with gen_limited_code_lengths().
+#-------------------------------------------------------------------
+def extract_canonical_codes(ptree, num_symbols = NUM_SYMBOLS,
+                            max_code_length = None):
+    sink = METRICS_SINK
+    if sink != None:
+        start_time = time.perf_counter()
+
+    len_table = get_code_lengths(ptree, num_symbols)
+
+    if max_code_length != None and max(len_table) > max_code_length:
+        len_table = gen_limited_code_lengths(get_tree_leaves(ptree), max_code_length,
+                                             num_symbols)
+    code_table = gen_canonical_codes(len_table)
+
+    if sink != None:
+        emit_metrics(sink, 'codes', start_time,
+                     symbols=sum(1 for length in len_table if length),
+                     max_len=max(len_table))
+    return (code_table, len_table)
+
+
+#-------------------------------------------------------------------
+# get_tree_leaves()
+#
+# Given a prefix tree returns a list with all leaf nodes.
+#-------------------------------------------------------------------
+def get_tree_leaves(ptree):
+    leaves = []
+    stack = [ptree]
+    while stack:
+        node = stack.pop()
+        if node[0] != None:
+            leaves.append(node)
+        else:
+            if node[3] != None:
+                stack.append(node[3])
+            if node[4] != None:
+                stack.append(node[4])
+    return leaves
+
+
+#-------------------------------------------------------------------
+# gen_limited_code_lengths()
+#
+# Given a list of leaf nodes returns a list with the code length
+# for each of the num_symbols possible chars, where no code is
+# longer than max_code_length bits. The lengths are optimal for
+# the limit and are computed using the package-merge algorithm.
+#
+# Items are tuples (weight, char, children). Leaves have a char
+# and packages have the pair of items they were made from.
+# Starting with the sorted leaves, the items at each level are
+# paired into packages which are merged with the leaves to form
+# the next level. The code length of a char is the number of
+# times its leaf occurs in the 2n - 2 least weight items of the
+# final level.
+#-------------------------------------------------------------------
+def gen_limited_code_lengths(nlist, max_code_length, num_symbols = NUM_SYMBOLS):
+    len_table = [0] * num_symbols
+    num_leaves = len(nlist)
+
+    if num_leaves == 1:
+        len_table[nlist[0][0]] = 1
+        return len_table
+
+    if num_leaves > (1 << max_code_length):
+        raise ValueError("%d chars can not be coded with at most %d bits."
+                         % (num_leaves, max_code_length))
+
+    leaves = sorted(((node[1], node[0], None) for node in nlist),
+                    key=lambda item: item[0])
+    items = leaves
+    for level in range(max_code_length - 1):
+        packages = [(items[i][0] + items[i + 1][0], None, (items[i], items[i + 1]))
+                    for i in range(0, len(items) - 1, 2)]
+        items = list(heapq.merge(leaves, packages, key=lambda item: item[0]))
+
+    stack = items[: 2 * num_leaves - 2]
+    while stack:
+        (weight, char, children) = stack.pop()
+        if char != None:
+            len_table[char] += 1
+        else:
+            stack.extend(children)
+
+    return len_table
+
+
+#-------------------------------------------------------------------
+# gen_clamped_code_lengths()
+#
+# Given a list with the optimal code length for each char
+# returns a list where no code is longer than max_code_length
+# bits, in time linear in the number of chars. The lengths are
+# not optimal for the limit but close to it.
+#
+# The number of codes of each length is counted with the long
+# codes clamped to max_code_length. While the Kraft sum is over
+# one the longest code below the limit is made one bit longer
+# and one of the clamped codes is moved up next to it, which
+# takes exactly one max_code_length code worth off the sum, as
+# in zlib. The lengths are then handed out again in the order of
+# the optimal lengths, so more frequent chars keep the shorter
+# codes.
+#-------------------------------------------------------------------
+def gen_clamped_code_lengths(len_table, max_code_length):
+    chars_by_length = [[] for length in range(max(len_table) + 1)]
+    for (char, length) in enumerate(len_table):
+        if length:
+            chars_by_length[length].append(char)
+
+    num_codes = len(len_table) - len(chars_by_length[0])
+    if num_codes > (1 << max_code_length):
+        raise ValueError("%d chars can not be coded with at most %d bits."
+                         % (num_codes, max_code_length))
+
+    bl_count = [0] * (max_code_length + 1)
+    for length in range(1, len(chars_by_length)):
+        bl_count[min(length, max_code_length)] += len(chars_by_length[length])
+
+    capacity = 1 << max_code_length
+    kraft_sum = sum(bl_count[length] << (max_code_length - length)
+                    for length in range(1, max_code_length + 1))
+    while kraft_sum > capacity:
+        bits = max_code_length - 1
+        while bl_count[bits] == 0:
+            bits -= 1
+        bl_count[bits] -= 1
+        bl_count[bits + 1] += 2
+        bl_count[max_code_length] -= 1
+        kraft_sum -= 1
+
+    clamped_table = [0] * len(len_table)
+    bits = 1
+    for chars in chars_by_length[1:]:
+        for char in chars:
+            while bl_count[bits] == 0:
+                bits += 1
+            clamped_table[char] = bits
+            bl_count[bits] -= 1
+    return clamped_table
+
+
+#-------------------------------------------------------------------
+# get_code_cost()
+#
+# Returns the total number of bits needed to code the given list
+# of nodes with the given code lengths.
+#-------------------------------------------------------------------
+def get_code_cost(nlist, len_table):
+    return sum(node[1] * len_table[node[0]] for node in nlist)
+
+
+#-------------------------------------------------------------------
+# get_entropy_bits()
+#
+# Returns the entropy in bits of data with the given byte
+# frequency list, i.e. the lower bound for the number of bits
+# needed to code the data with any prefix code.
+#-------------------------------------------------------------------
+def get_entropy_bits(freq_list):
+    total = sum(freq_list)
+    return sum(freq * math.log2(total / freq) for freq in freq_list if freq)
+
+
+#-------------------------------------------------------------------
+# class CodeTableCache
+#
+# A bounded cache of code tables with LRU eviction. Tables are
+# keyed by a fingerprint of the frequency list they were built
+# for, where each frequency is quantized to the power of two of
+# its share of the total in units of 2^-CACHE_QUANT_BITS. Chars
+# with a smaller share than that are ignored. Histograms with
+# near-identical statistics get the same fingerprint, and so
+# the same table.
+#
+# A cached table is only reused if it has a code for every char
+# in the new histogram, and if its cost for the new histogram,
+# relative to the entropy of the histogram, is within
+# cost_margin of the cost the table had for the histogram it was
+# built for. The table with the same fingerprint is tried first,
+# then the CACHE_SCAN most recently used tables, since blocks
+# from the same source often differ in a few rare chars only.
+# Otherwise the table is rebuilt and replaces the cached one.
+# Each entry is a tuple (code_table, len_table, redundancy),
+# where redundancy is the built cost divided by the entropy.
+#
+# A histogram with a single char has zero entropy. A table is
+# then only reused if it codes the char with one bit, and a table
+# built for such a histogram gets redundancy 1.
+#
+# The tables are built from the frequencies as they are, so
+# chars that do not occur get no code. This keeps the codes short
+# and the packed code lengths small, since the runs of zero
+# lengths are packed. A table is therefore only reused for a
+# histogram whose chars all occurred where the table was built.
+#
+# The counters hits, misses, rejects (fingerprint found but
+# cost too high) and evictions are kept as attributes.
+#
+# get_codes() and get_stats() hold the lock of the cache, so one
+# cache can be shared by threads, such as the executor threads
+# used by huffman_async.
+#-------------------------------------------------------------------
+class CodeTableCache:
+    def __init__(self, max_entries = CACHE_SIZE, cost_margin = CACHE_COST_MARGIN,
+                 max_code_length = None):
+        self.max_entries = max_entries
+        self.cost_margin = cost_margin
+        self.max_code_length = max_code_length
+        self.tables = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejects = 0
+        self.evictions = 0
+
+    def get_fingerprint(self, freq_list):
+        total = sum(freq_list)
+        return tuple(((freq << CACHE_QUANT_BITS) // total).bit_length()
+                     for freq in freq_list)
+
+    def is_usable(self, entry, freq_list, entropy_bits):
+        (code_table, len_table, redundancy) = entry
+        cost = 0
+        for (freq, length) in zip(freq_list, len_table):
+            if freq and not length:
+                return False
+            cost += freq * length
+
+        if entropy_bits == 0:
+            return cost <= sum(freq_list)
+        return cost <= redundancy * entropy_bits * (1 + self.cost_margin)
+
+    def get_codes(self, freq_list):
+        key = self.get_fingerprint(freq_list)
+        entropy_bits = get_entropy_bits(freq_list)
+
+        with self.lock:
+            keys = [old_key for old_key in list(self.tables)[-CACHE_SCAN :]
+                    if old_key != key]
+            if key in self.tables:
+                keys.append(key)
+
+            for old_key in reversed(keys):
+                (code_table, len_table, redundancy) = self.tables[old_key]
+                if self.is_usable(self.tables[old_key], freq_list, entropy_bits):
+                    self.tables.move_to_end(old_key)
+                    self.hits += 1
+                    return (code_table, len_table)
+
+            if key in self.tables:
+                self.rejects += 1
+            else:
+                self.misses += 1
+
+            (code_table, len_table) = gen_histogram_canonical_codes(freq_list,
+                                                                    self.max_code_length)
+            cost = sum(freq * length for (freq, length) in zip(freq_list, len_table))
+            redundancy = cost / entropy_bits if entropy_bits else 1.0
+
+            self.tables[key] = (code_table, len_table, redundancy)
+            self.tables.move_to_end(key)
+            if len(self.tables) > self.max_entries:
+                self.tables.popitem(last=False)
+                self.evictions += 1
+
+            return (code_table, len_table)
+
+    def get_stats(self):
+        with self.lock:
+            return {'entries' : len(self.tables), 'hits' : self.hits,
+                    'misses' : self.misses, 'rejects' : self.rejects,
+                    'evictions' : self.evictions}
+
+
+#-------------------------------------------------------------------
+# canonical_to_prefix_codes()
+#
+# Given canonical code and length tables and the list of nodes
+# the codes were built from, returns a prefix code db in the
+# same format as extract_prefix_codes(). Useful for printing
+# the canonical codes using print_prefix_codes().
+#-------------------------------------------------------------------
+def canonical_to_prefix_codes(code_table, len_table, nlist):
+    prefix_dict = {}
+    for node in nlist:
+        char = node[0]
+        length = len_table[char]
+        if length:
+            prefix_dict[char] = (node[1], format(code_table[char], '0%db' % length))
+    return prefix_dict
+
+
 #-------------------------------------------------------------------
 # gen_prefix_tree()
 #
 # Given a list of tuples with frequency (weight) for a character
 # the function returns the corresponding tuple based prefix tree.
+#
+# The two nodes with least weight are found using a heap, which
+# makes building the tree O(n log n). If the list is already
+# sorted by weight in decreasing order (as returned by
+# sort_node_list()) the linear time two queue builder is used.
 #-------------------------------------------------------------------
 def gen_prefix_tree(nlist):
-    while (len(nlist) > 1):
-        if VERBOSE:
-            print("Length of prefix list: %d" % len(nlist))
+    sink = METRICS_SINK
+    if sink != None:
+        start_time = time.perf_counter()
 
-        nlist = sort_node_list(nlist)
-        node1 = nlist.pop()
-        node2 = nlist.pop()
+    if is_sorted_node_list(nlist):
+        ptree = gen_sorted_prefix_tree(nlist)
+    else:
+        ptree = gen_heap_prefix_tree(nlist)
 
-        if VERBOSE:
-            print("node1 weigth: %d" % node1[1])
-            print("node2 weigth: %d" % node2[1])
+    if sink != None:
+        emit_metrics(sink, 'tree', start_time, symbols=len(nlist))
+    return ptree
 
-        new_weight = node1[1] + node2[1]
+
+#-------------------------------------------------------------------
+# gen_heap_prefix_tree()
+#
+# Given a list of nodes in any order returns the corresponding
+# tuple based prefix tree. The two nodes with least weight are
+# found using a heap.
+#-------------------------------------------------------------------
+def gen_heap_prefix_tree(nlist):
+    heap = [(node[1], i, node) for (i, node) in enumerate(nlist)]
+    heapq.heapify(heap)
+    seq = len(heap)
+
+    while (len(heap) > 1):
+        (weight1, i1, node1) = heapq.heappop(heap)
+        (weight2, i2, node2) = heapq.heappop(heap)
+
+        new_weight = weight1 + weight2
         new_children = 2 + node1[2] + node2[2]
         new_node = (None, new_weight, new_children, node1, node2)
-        nlist.append(new_node)
+        heapq.heappush(heap, (new_weight, seq, new_node))
+        seq += 1
+
+    return heap[0][2]
 
-    return nlist.pop()
+
+#-------------------------------------------------------------------
+# gen_sorted_prefix_tree()
+#
+# Given a list of nodes sorted by weight in decreasing order
+# returns the corresponding tuple based prefix tree. The tree is
+# built in linear time using two queues, one with the leaves and
+# one with the merged nodes. Since merged nodes are created in
+# increasing weight order, the two nodes with least weight are
+# always found at the head of the queues.
+#-------------------------------------------------------------------
+def gen_sorted_prefix_tree(nlist):
+    leaves = nlist[::-1]
+    num_leaves = len(leaves)
+    leaf_idx = 0
+    merged = deque()
+
+    while ((num_leaves - leaf_idx) + len(merged) > 1):
+        pair = []
+        for i in range(2):
+            if leaf_idx < num_leaves and\
+               (not merged or leaves[leaf_idx][1] <= merged[0][1]):
+                pair.append(leaves[leaf_idx])
+                leaf_idx += 1
+            else:
+                pair.append(merged.popleft())
+
+        (node1, node2) = pair
+        new_weight = node1[1] + node2[1]
+        new_children = 2 + node1[2] + node2[2]
+        merged.append((None, new_weight, new_children, node1, node2))
+
+    if merged:
+        return merged.pop()
+    return leaves[leaf_idx]
+
+
+#-------------------------------------------------------------------
+# is_sorted_node_list()
+#
+# Returns True if the given list of nodes is sorted by weight
+# in decreasing order.
+#-------------------------------------------------------------------
+def is_sorted_node_list(nlist):
+    for i in range(1, len(nlist)):
+        if nlist[i - 1][1] < nlist[i][1]:
+            return False
+    return True
 
 
 #-------------------------------------------------------------------
@@ -156,22 +1040,9 @@ def gen_prefix_tree(nlist):
 # sorted by weight in decreasing order.
 #-------------------------------------------------------------------
 def sort_node_list(nlist):
-    nodes = 0
-    new_list = []
     if VERBOSE:
         print("Length of given list: %d" % len(nlist))
-    for i in range(len(nlist)):
-        node = nlist.pop()
-        nodes += 1
-        if len(new_list) == 0:
-            new_list.append(node)
-        else:
-            i = 0
-            while ((i < len(new_list) and (node[1] < new_list[i][1]))):
-                i += 1
-            new_list = new_list[:i] + [node] + new_list[i:]
-
-    return new_list
+    return sorted(nlist, key=lambda node: node[1], reverse=True)
 
 
 #-------------------------------------------------------------------
@@ -180,8 +1051,13 @@ def sort_node_list(nlist):
 # Given a db with prefix codes for a set of keys (chars) will
 # print the contents of the db as well as some interesting
 # statistics.
+#
+# If the db with the unconstrained Huffman codes for the same
+# chars is given as ref_codes, the cost in bits and percent of
+# the given codes compared to the unconstrained codes is also
+# printed.
 #-------------------------------------------------------------------
-def print_prefix_codes(prefix_codes):
+def print_prefix_codes(prefix_codes, ref_codes = None):
     min_len = 100000000
     max_len = 0
     num_raw_bits = 0
@@ -224,6 +1100,19 @@ def print_prefix_codes(prefix_codes):
     print("Reduction:                                    %02d percent" % reduction)
     print("")
 
+    if ref_codes != None:
+        num_ref_bits = 0
+        for key in ref_codes:
+            (weight, prefix) = ref_codes[key]
+            num_ref_bits += len(prefix) * weight
+        extra_bits = num_prefix_bits - num_ref_bits
+
+        print("Total number of bits with unconstrained codes: %016d" % num_ref_bits)
+        print("Extra bits compared to unconstrained codes:    %016d" % extra_bits)
+        print("Cost compared to unconstrained codes:          %.4f percent" %\
+              (100.0 * extra_bits / max(1, num_ref_bits)))
+        print("")
+
 
 #-------------------------------------------------------------------
 # gen_random_node_list()
@@ -240,36 +1129,106 @@ def gen_random_node_list(max_types, max_nums):
 
 
 #-------------------------------------------------------------------
-# gen_node_list(bytestring)
+# gen_histogram()
 #
-# Generates a list of nodes based on the given string.
-# contains a randomly selected frequency of a character from the
-# set of characters [chr(0) .. chr((max_types - 1))]
+# Returns a list with the number of times each byte value occurs
+# in the given bytes-like object. The data is counted in chunks
+# of chunk_size bytes. NumPy bincount is used when NumPy is
+# available, otherwise the C counting loop used by Counter.
+#-------------------------------------------------------------------
+def gen_histogram(bytestring, chunk_size = CHUNK_SIZE):
+    freq_list = [0] * 256
+    update_histogram(freq_list, bytestring, chunk_size)
+    return freq_list
+
+
+#-------------------------------------------------------------------
+# update_histogram()
 #
-# The nodes are tuples with the contents:
-# (char, weight, left subtree, right subtree)
+# Adds the byte counts for the given bytes-like object to the
+# given frequency list.
+#-------------------------------------------------------------------
+def update_histogram(freq_list, bytestring, chunk_size = CHUNK_SIZE):
+    sink = METRICS_SINK
+    if sink != None:
+        start_time = time.perf_counter()
+
+    data = memoryview(bytestring).cast('B')
+
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start : start + chunk_size]
+        if numpy is not None:
+            counts = numpy.bincount(numpy.frombuffer(chunk, dtype=numpy.uint8),
+                                    minlength=256)
+            for i in numpy.flatnonzero(counts):
+                freq_list[i] += int(counts[i])
+        else:
+            counts = Counter(chunk)
+            for i in counts:
+                freq_list[i] += counts[i]
+
+    if sink != None:
+        emit_metrics(sink, 'histogram', start_time, bytes=len(data))
+    return freq_list
+
+
+#-------------------------------------------------------------------
+# gen_file_histogram()
 #
-# For leaf nodes the subtrees are None. For all other nodes
-# the char is None."
+# Returns the byte frequency list for the file with the given
+# name. The file is read chunk_size bytes at a time into a
+# reused buffer.
 #-------------------------------------------------------------------
-def gen_node_list(bytestring):
+def gen_file_histogram(filename, chunk_size = CHUNK_SIZE):
     freq_list = [0] * 256
+    buf = bytearray(chunk_size)
+    view = memoryview(buf)
+    with open(filename, 'rb') as f:
+        num_read = f.readinto(buf)
+        while num_read:
+            update_histogram(freq_list, view[:num_read], chunk_size)
+            num_read = f.readinto(buf)
+    return freq_list
 
-    for ch in bytestring:
-        freq_list[ch] += 1
 
+#-------------------------------------------------------------------
+# gen_histogram_node_list()
+#
+# Generates a list of leaf nodes from the given byte frequency
+# list. Only bytes that occur get a node. The nodes are tuples
+# with the contents:
+# (char, weight, 0, None, None)
+#-------------------------------------------------------------------
+def gen_histogram_node_list(freq_list):
     if (DUMP_FREQS):
         for i in range(256):
             print("Freq Char 0x%02x = 0x%08x" % (i, freq_list[i]))
 
     node_list = []
-    for i in range(256):
+    for i in range(len(freq_list)):
         if  freq_list[i] > 0:
             node_list.append((i, freq_list[i], 0, None, None))
 
     return node_list
 
 
+#-------------------------------------------------------------------
+# gen_node_list(bytestring)
+#
+# Generates a list of nodes based on the given string.
+# contains a randomly selected frequency of a character from the
+# set of characters [chr(0) .. chr((max_types - 1))]
+#
+# The nodes are tuples with the contents:
+# (char, weight, left subtree, right subtree)
+#
+# For leaf nodes the subtrees are None. For all other nodes
+# the char is None."
+#-------------------------------------------------------------------
+def gen_node_list(bytestring):
+    return gen_histogram_node_list(gen_histogram(bytestring))
+
+
 #-------------------------------------------------------------------
 # encode_string()
 #
@@ -286,20 +1245,710 @@ def bitencode_string(src_string, code_db):
     return enc_string
 
 
+#-------------------------------------------------------------------
+# bitencode_bytes()
+#
+# Encode the given bytes using the given code and length tables.
+# The last byte is padded with zero bits. Returns a bytearray
+# with the encoded data.
+#-------------------------------------------------------------------
+def bitencode_bytes(src_bytes, code_table, len_table):
+    (dst_bytes, acc, acc_bits) = bitencode_chunk(src_bytes, code_table,
+                                                 len_table, 0, 0)
+    dst_bytes += flush_bits(acc, acc_bits)
+    return dst_bytes
+
+
+#-------------------------------------------------------------------
+# bitencode_chunk()
+#
+# Encode the given bytes-like object using the given code and
+# length tables, continuing from the acc_bits bits left in the
+# accumulator acc by the previous chunk. The codes are packed
+# most significant bit first into an integer bit accumulator.
+# Whenever at least 32 bits are collected, whole bytes are
+# flushed into a bytearray that is preallocated to the exact
+# size of the output.
+#
+# Returns a tuple (dst_bytes, acc, acc_bits) where dst_bytes
+# holds all whole bytes and acc holds the remaining (less than
+# 8) bits for the next chunk or for flush_bits(). Raises
+# ValueError if a char in the data has no code.
+#
+# For alphabets larger than bytes src_bytes may instead be an
+# array of symbols, such as array('I').
+#
+# If NumPy is available, chunks of at least NUMPY_MIN_SIZE chars
+# are encoded with bitencode_numpy_chunk() instead.
+#-------------------------------------------------------------------
+def bitencode_chunk(src_bytes, code_table, len_table, acc, acc_bits):
+    sink = METRICS_SINK
+    if sink != None:
+        start_time = time.perf_counter()
+
+    src_bytes = memoryview(src_bytes)
+    if src_bytes.itemsize == 1:
+        src_bytes = src_bytes.cast('B')
+
+    if numpy is not None and len(src_bytes) >= NUMPY_MIN_SIZE and\
+       max(len_table) <= NUMPY_MAX_CODE_LENGTH:
+        (dst_bytes, acc, acc_bits) = bitencode_numpy_chunk(src_bytes, code_table,
+                                                           len_table, acc, acc_bits)
+        if sink != None:
+            emit_metrics(sink, 'encode', start_time, bytes_in=len(src_bytes),
+                         bytes_out=len(dst_bytes))
+        return (dst_bytes, acc, acc_bits)
+
+    for ch in set(src_bytes):
+        if not len_table[ch]:
+            raise ValueError("Char %d has no code." % ch)
+
+    num_bits = acc_bits + sum(map(len_table.__getitem__, src_bytes))
+    dst_bytes = bytearray(num_bits >> 3)
+
+    pos = 0
+    for ch in src_bytes:
+        length = len_table[ch]
+        acc = (acc << length) | code_table[ch]
+        acc_bits += length
+        while acc_bits >= 32:
+            acc_bits -= 32
+            dst_bytes[pos : pos + 4] = (acc >> acc_bits).to_bytes(4, 'big')
+            acc &= (1 << acc_bits) - 1
+            pos += 4
+
+    while acc_bits >= 8:
+        acc_bits -= 8
+        dst_bytes[pos] = (acc >> acc_bits) & 0xff
+        pos += 1
+    acc &= (1 << acc_bits) - 1
+
+    if sink != None:
+        emit_metrics(sink, 'encode', start_time, bytes_in=len(src_bytes),
+                     bytes_out=len(dst_bytes))
+    return (dst_bytes, acc, acc_bits)
+
+
+#-------------------------------------------------------------------
+# bitencode_numpy_chunk()
+#
+# Vectorized version of bitencode_chunk() using NumPy, with the
+# same arguments and return value. The input is encoded
+# NUMPY_CHUNK_SIZE chars at a time:
+#
+# 1. The code and length of every char are looked up by indexing
+#    the code and length arrays with the input array.
+# 2. The bit offset of every code is found with a cumulative sum
+#    of the lengths, continuing after the acc_bits carried bits.
+# 3. Every code is shifted into place in the 64 bit output word
+#    holding its first bit. A code crossing into the next word
+#    also gets its low bits shifted into that word. The codes do
+#    not overlap, so the words are formed by summing the codes
+#    in each word with add.reduceat().
+# 4. The words are written as big endian bytes, keeping the last
+#    partial byte in the accumulator.
+#
+# Codes must be at most NUMPY_MAX_CODE_LENGTH bits.
+#-------------------------------------------------------------------
+def bitencode_numpy_chunk(src_bytes, code_table, len_table, acc, acc_bits):
+    src = numpy.asarray(memoryview(src_bytes))
+    code_arr = numpy.array(code_table, dtype=numpy.uint64)
+    len_arr = numpy.array(len_table, dtype=numpy.int64)
+    dst_bytes = bytearray()
+
+    for start in range(0, len(src), NUMPY_CHUNK_SIZE):
+        chunk = src[start : start + NUMPY_CHUNK_SIZE]
+        lengths = len_arr[chunk]
+        if lengths.min() == 0:
+            raise ValueError("Char %d has no code." % chunk[lengths.argmin()])
+        codes = code_arr[chunk]
+        ends = numpy.cumsum(lengths) + acc_bits
+        num_bits = int(ends[-1])
+        offsets = ends - lengths
+
+        word_idx = offsets >> 6
+        code_ends = (offsets & 63) + lengths
+        spill = code_ends > 64
+        shifts = numpy.where(spill, code_ends - 64, 64 - code_ends).astype(numpy.uint64)
+        parts = numpy.where(spill, codes >> shifts, codes << shifts)
+
+        words = numpy.zeros((num_bits + 63) >> 6, dtype=numpy.uint64)
+        word_starts = numpy.flatnonzero(numpy.diff(word_idx)) + 1
+        word_starts = numpy.concatenate(([0], word_starts))
+        words[word_idx[word_starts]] = numpy.add.reduceat(parts, word_starts)
+        spill_codes = codes[spill]
+        spill_shifts = (128 - code_ends[spill]).astype(numpy.uint64)
+        words[word_idx[spill] + 1] += spill_codes << spill_shifts
+        if acc_bits:
+            words[0] += numpy.uint64(acc << (64 - acc_bits))
+
+        enc_bytes = words.astype('>u8').tobytes()
+        whole_bytes = num_bits >> 3
+        dst_bytes += enc_bytes[: whole_bytes]
+        acc_bits = num_bits & 7
+        if acc_bits:
+            acc = enc_bytes[whole_bytes] >> (8 - acc_bits)
+        else:
+            acc = 0
+
+    return (dst_bytes, acc, acc_bits)
+
+
+#-------------------------------------------------------------------
+# flush_bits()
+#
+# Returns the bits left in the accumulator as bytes, with the
+# last byte padded with zero bits.
+#-------------------------------------------------------------------
+def flush_bits(acc, acc_bits):
+    pad_bits = -acc_bits % 8
+    return (acc << pad_bits).to_bytes((acc_bits + pad_bits) >> 3, 'big')
+
+
+#-------------------------------------------------------------------
+# get_code_tables()
+#
+# Given a prefix code db as returned by extract_prefix_codes()
+# returns a tuple (code_table, len_table) with integer codes
+# and code lengths, the same format as extract_canonical_codes().
+#-------------------------------------------------------------------
+def get_code_tables(code_db, num_symbols = NUM_SYMBOLS):
+    code_table = [0] * num_symbols
+    len_table = [0] * num_symbols
+    for char in code_db:
+        (weight, prefix_str) = code_db[char]
+        code_table[char] = int(prefix_str, 2)
+        len_table[char] = len(prefix_str)
+    return (code_table, len_table)
+
+
+#-------------------------------------------------------------------
+# gen_decode_tables()
+#
+# Given code and length tables returns a tuple (lookup_bits,
+# max_len, primary, secondary) used by decode_bytes().
+#
+# The primary table is indexed by the next lookup_bits bits of
+# the stream. For codes not longer than lookup_bits the entry is
+# (char << 8 | code length), filled in for every index that
+# starts with the code. For longer codes the entry is
+# -(index + 1) into the secondary list. Each secondary entry is
+# a tuple (sub_bits, sub_table) where the sub table is indexed
+# by the sub_bits bits following the bits already used and holds
+# (char << 8 | total code length) entries, or again -(index + 1)
+# for codes that are longer still. The sub tables have at most
+# SUB_LOOKUP_BITS index bits, so the table size grows with the
+# number of long codes, not with their length.
+#-------------------------------------------------------------------
+def gen_decode_tables(code_table, len_table, lookup_bits = LOOKUP_BITS):
+    sink = METRICS_SINK
+    if sink != None:
+        start_time = time.perf_counter()
+
+    max_len = max(len_table) if len_table else 0
+    lookup_bits = max(1, min(lookup_bits, max_len))
+    codes = [(char, code_table[char], len_table[char])
+             for char in range(len(len_table)) if len_table[char]]
+    secondary = []
+    primary = gen_lookup_table(codes, 0, lookup_bits, secondary)
+
+    if sink != None:
+        emit_metrics(sink, 'decode_tables', start_time, tables=1 + len(secondary),
+                     entries=len(primary) + sum(len(sub_table) for
+                                                (sub_bits, sub_table) in secondary))
+    return (lookup_bits, max_len, primary, secondary)
+
+
+#-------------------------------------------------------------------
+# gen_lookup_table()
+#
+# Returns a decode table indexed by the table_bits bits following
+# the used_bits bits shared by all the given (char, code, length)
+# tuples. Codes longer than used_bits + table_bits are grouped by
+# their next table_bits bits into sub tables that are appended to
+# the secondary list. Used by gen_decode_tables().
+#-------------------------------------------------------------------
+def gen_lookup_table(codes, used_bits, table_bits, secondary):
+    table = [0] * (1 << table_bits)
+    long_codes = {}
+    for (char, code, length) in codes:
+        rest_len = length - used_bits
+        rest = code & ((1 << rest_len) - 1)
+        if rest_len <= table_bits:
+            shift = table_bits - rest_len
+            entry = (char << 8) | length
+            start = rest << shift
+            for i in range(start, start + (1 << shift)):
+                table[i] = entry
+        else:
+            prefix = rest >> (rest_len - table_bits)
+            long_codes.setdefault(prefix, []).append((char, code, length))
+
+    for prefix in sorted(long_codes):
+        sub_codes = long_codes[prefix]
+        sub_used = used_bits + table_bits
+        sub_bits = min(max(length for (char, code, length) in sub_codes) - sub_used,
+                       SUB_LOOKUP_BITS)
+        index = len(secondary)
+        secondary.append(None)
+        secondary[index] = (sub_bits, gen_lookup_table(sub_codes, sub_used, sub_bits,
+                                                       secondary))
+        table[prefix] = -(index + 1)
+    return table
+
+
+#-------------------------------------------------------------------
+# decode_bytes()
+#
+# Decode num_chars chars from the given bytes using the given
+# decode tables. Returns the decoded data as bytes.
+#-------------------------------------------------------------------
+def decode_bytes(src_bytes, decode_tables, num_chars):
+    (dst_bytes, acc, acc_bits) = decode_chunk(src_bytes, decode_tables,
+                                              num_chars, 0, 0)
+    if len(dst_bytes) < num_chars:
+        raise ValueError("Encoded data ended before %d chars were decoded."
+                         % num_chars)
+    return bytes(dst_bytes)
+
+
+#-------------------------------------------------------------------
+# decode_chunk()
+#
+# Decode up to num_chars chars from the given bytes-like object
+# using the given decode tables, continuing from the acc_bits
+# bits left in the accumulator acc by the previous chunk. The
+# bits are read most significant bit first. Up to lookup_bits
+# bits are resolved per table lookup, codes longer than that
+# need one more lookup in a secondary table.
+#
+# Decoding stops when num_chars chars have been decoded or when
+# the remaining bits do not hold a complete code. Returns a tuple
+# (dst_bytes, acc, acc_bits) with the decoded chars and the bits
+# to carry over to the next chunk. Input bytes not yet read into
+# the accumulator when num_chars is reached are ignored.
+#
+# If symbols is set the decoded chars are returned in an
+# array('I') instead, for alphabets larger than bytes.
+#-------------------------------------------------------------------
+def decode_chunk(src_bytes, decode_tables, num_chars, acc, acc_bits,
+                 symbols = False):
+    sink = METRICS_SINK
+    if sink != None:
+        start_time = time.perf_counter()
+
+    src_bytes = memoryview(src_bytes).cast('B')
+    (lookup_bits, max_len, primary, secondary) = decode_tables
+    lookup_mask = (1 << lookup_bits) - 1
+    num_bytes = len(src_bytes)
+    num_chars = min(num_chars, acc_bits + num_bytes * 8)
+    if symbols:
+        dst_bytes = array('I', bytes(4 * num_chars))
+    else:
+        dst_bytes = bytearray(num_chars)
+
+    pos = 0
+    i = 0
+    while i < num_chars:
+        while acc_bits < max_len and pos < num_bytes:
+            acc = (acc << 8) | src_bytes[pos]
+            pos += 1
+            acc_bits += 8
+
+        if acc_bits >= max_len:
+            window = acc
+            window_bits = acc_bits
+        else:
+            window = acc << (max_len - acc_bits)
+            window_bits = max_len
+
+        entry = primary[(window >> (window_bits - lookup_bits)) & lookup_mask]
+        if entry < 0:
+            used_bits = lookup_bits
+            while entry < 0:
+                (sub_bits, sub_table) = secondary[-entry - 1]
+                used_bits += sub_bits
+                entry = sub_table[(window >> (window_bits - used_bits)) &\
+                                  ((1 << sub_bits) - 1)]
+
+        length = entry & 0xff
+        if length == 0:
+            raise ValueError("Invalid code in encoded data.")
+        if length > acc_bits:
+            break
+
+        dst_bytes[i] = entry >> 8
+        i += 1
+        acc_bits -= length
+        acc &= (1 << acc_bits) - 1
+
+    del dst_bytes[i:]
+
+    if sink != None:
+        emit_metrics(sink, 'decode', start_time, bytes_in=len(src_bytes),
+                     bytes_out=i)
+    return (dst_bytes, acc, acc_bits)
+
+
 #-------------------------------------------------------------------
 # decode_string()
 #
-# Decode the given string using the given database.
+# Decode num_chars chars from the given string using the given
+# prefix code db as returned by extract_prefix_codes().
 #-------------------------------------------------------------------
-def decode_string(src_string, code_db):
-    for ch in src_string:
-        bistring = ""
-        for i in range(8):
-            my_bit = (ord(ch) >> 8) & 0x01
-            ch = (ch << 1) & 0xff
-            bitstring.append(my_bit)
+def decode_string(src_string, code_db, num_chars):
+    if isinstance(src_string, str):
+        src_string = src_string.encode('latin-1')
+    (code_table, len_table) = get_code_tables(code_db)
+    decode_tables = gen_decode_tables(code_table, len_table)
+    return decode_bytes(src_string, decode_tables, num_chars)
+
 
-        print("Char: 0x%02x, bitstring: %s" % (ord(ch), bitstring))
+#-------------------------------------------------------------------
+# encode_batch()
+#
+# Encode a list of messages with the same code table. The
+# messages are encoded back to back as one bit stream, without
+# padding between them. Returns a tuple (packed_bytes, offsets)
+# where offsets is an array with the bit offset of the start of
+# each message in packed_bytes followed by the end of the last.
+# The code table setup and the encoder call are done once for
+# the whole batch instead of once per message.
+#-------------------------------------------------------------------
+def encode_batch(messages, code_table, len_table):
+    sink = METRICS_SINK
+    if sink != None:
+        start_time = time.perf_counter()
+
+    get_len = len_table.__getitem__
+    offsets = array('Q', [0])
+    bit_pos = 0
+    for message in messages:
+        bit_pos += sum(map(get_len, message))
+        offsets.append(bit_pos)
+
+    (packed_bytes, acc, acc_bits) = bitencode_chunk(b''.join(messages), code_table,
+                                                    len_table, 0, 0)
+    packed_bytes += flush_bits(acc, acc_bits)
+
+    if sink != None:
+        emit_metrics(sink, 'encode_batch', start_time, messages=len(messages),
+                     bytes_out=len(packed_bytes))
+    return (packed_bytes, offsets)
+
+
+#-------------------------------------------------------------------
+# decode_batch()
+#
+# Decode a batch encoded by encode_batch() using the given decode
+# tables. The message boundaries are given by the bit offsets,
+# so no char counts are needed. The whole batch is decoded with
+# decode_chunk(), with the bits after the last whole byte
+# decoded by a second call, and then split into messages where
+# the bit offsets of the chars match the given offsets. Returns
+# a list with the decoded messages. Raises ValueError if a code
+# crosses a message boundary or the data ends in the middle of a
+# code.
+#-------------------------------------------------------------------
+def decode_batch(packed_bytes, offsets, decode_tables):
+    sink = METRICS_SINK
+    if sink != None:
+        start_time = time.perf_counter()
+
+    src_bytes = memoryview(packed_bytes).cast('B')
+    end_bit = offsets[-1]
+    if end_bit > len(src_bytes) * 8:
+        raise ValueError("Packed data is shorter than the given offsets.")
+    if offsets[0] != 0:
+        raise ValueError("The first message must start at bit 0.")
+
+    (dst_bytes, acc, acc_bits) = decode_chunk(src_bytes[: end_bit >> 3],
+                                              decode_tables, end_bit, 0, 0)
+    tail_bits = end_bit & 7
+    if tail_bits:
+        acc = (acc << tail_bits) | (src_bytes[end_bit >> 3] >> (8 - tail_bits))
+        (tail, acc, acc_bits) = decode_chunk(b'', decode_tables, end_bit, acc,
+                                             acc_bits + tail_bits)
+        dst_bytes += tail
+    if acc_bits:
+        raise ValueError("Packed data ends in the middle of a code.")
+
+    char_lengths = get_decode_lengths(decode_tables)
+    bit_ends = list(accumulate(map(char_lengths.__getitem__, dst_bytes), initial=0))
+    char_starts = []
+    for (i, offset) in enumerate(offsets):
+        idx = bisect_left(bit_ends, offset)
+        if idx == len(bit_ends) or bit_ends[idx] != offset:
+            raise ValueError("Code crosses the end of message %d." % (i - 1))
+        char_starts.append(idx)
+
+    messages = [bytes(dst_bytes[char_starts[i] : char_starts[i + 1]])
+                for i in range(len(char_starts) - 1)]
+
+    if sink != None:
+        emit_metrics(sink, 'decode_batch', start_time, messages=len(messages),
+                     bytes_out=len(dst_bytes))
+    return messages
+
+
+#-------------------------------------------------------------------
+# get_decode_lengths()
+#
+# Returns a list with the code length of each char in the given
+# decode tables, zero for chars without a code.
+#-------------------------------------------------------------------
+def get_decode_lengths(decode_tables):
+    (lookup_bits, max_len, primary, secondary) = decode_tables
+    char_lengths = [0] * NUM_SYMBOLS
+    for table in [primary] + [sub_table for (sub_bits, sub_table) in secondary]:
+        for entry in set(table):
+            if entry > 0:
+                char_lengths[entry >> 8] = entry & 0xff
+    return char_lengths
+
+
+#-------------------------------------------------------------------
+# get_stream_sizes()
+#
+# Returns a list with the number of chars in each of the
+# num_streams sub-streams of num_chars chars. All sub-streams
+# hold the same number of chars except at the end, where the
+# last non empty sub-stream may be shorter and the rest empty.
+#-------------------------------------------------------------------
+def get_stream_sizes(num_chars, num_streams):
+    stream_chars = -(-num_chars // num_streams)
+    return [max(0, min(stream_chars, num_chars - i * stream_chars))
+            for i in range(num_streams)]
+
+
+#-------------------------------------------------------------------
+# encode_streams()
+#
+# Encode the given bytes-like object as num_streams interleaved
+# sub-streams, in the same way as Huff0. The data is split into
+# num_streams consecutive parts as given by get_stream_sizes()
+# and each part is encoded into its own bit stream, padded to a
+# full byte. The sub-streams are preceded by a jump table with
+# the size in bytes of all sub-streams but the last, stored in
+# JUMP_ENTRY_SIZE bytes each.
+#
+# Since every sub-stream starts at a known position, the decoder
+# can advance one bit cursor per sub-stream in the same loop
+# iteration. See decode_streams().
+#-------------------------------------------------------------------
+def encode_streams(src_bytes, code_table, len_table, num_streams = NUM_STREAMS):
+    if not 1 <= num_streams <= MAX_STREAMS:
+        raise ValueError("Number of streams must be 1 to %d." % MAX_STREAMS)
+
+    streams = []
+    start = 0
+    for stream_chars in get_stream_sizes(len(src_bytes), num_streams):
+        streams.append(bitencode_bytes(src_bytes[start : start + stream_chars],
+                                       code_table, len_table))
+        start += stream_chars
+
+    jump_table = b''.join(len(stream).to_bytes(JUMP_ENTRY_SIZE, 'big')
+                          for stream in streams[:-1])
+    return jump_table + b''.join(streams)
+
+
+#-------------------------------------------------------------------
+# decode_streams()
+#
+# Decode num_chars chars encoded by encode_streams() with
+# num_streams sub-streams, using the given decode tables.
+# Returns the decoded data as bytes.
+#
+# If NumPy is available, there are at least NUMPY_MIN_LANES
+# sub-streams and no code is longer than NUMPY_MAX_LANE_BITS
+# bits, all sub-streams are decoded in lockstep as vector lanes
+# by decode_numpy_lanes(). Otherwise the sub-streams are decoded
+# one after the other with decode_chunk().
+#-------------------------------------------------------------------
+def decode_streams(src_bytes, decode_tables, num_chars, num_streams = NUM_STREAMS):
+    if not 1 <= num_streams <= MAX_STREAMS:
+        raise ValueError("Number of streams must be 1 to %d." % MAX_STREAMS)
+
+    src_bytes = memoryview(src_bytes).cast('B')
+    jump_size = (num_streams - 1) * JUMP_ENTRY_SIZE
+    if len(src_bytes) < jump_size:
+        raise ValueError("Encoded data ended in the jump table.")
+
+    starts = [jump_size]
+    for i in range(0, jump_size, JUMP_ENTRY_SIZE):
+        starts.append(starts[-1] + int.from_bytes(src_bytes[i : i + JUMP_ENTRY_SIZE],
+                                                  'big'))
+    if starts[-1] > len(src_bytes):
+        raise ValueError("Invalid jump table in encoded data.")
+    ends = starts[1:] + [len(src_bytes)]
+    stream_sizes = get_stream_sizes(num_chars, num_streams)
+
+    (lookup_bits, max_len, primary, secondary) = decode_tables
+    if numpy is not None and num_streams >= NUMPY_MIN_LANES and\
+       0 < max_len <= NUMPY_MAX_LANE_BITS:
+        return decode_numpy_lanes(src_bytes, decode_tables, starts, ends,
+                                  stream_sizes)
+
+    dst_bytes = bytearray()
+    for i in range(num_streams):
+        dst_bytes += decode_bytes(src_bytes[starts[i] : ends[i]], decode_tables,
+                                  stream_sizes[i])
+    return bytes(dst_bytes)
+
+
+#-------------------------------------------------------------------
+# decode_numpy_lanes()
+#
+# Decode the sub-streams of encode_streams() data with NumPy,
+# one sub-stream per vector lane. The sub-streams start at the
+# byte offsets in starts, end at the offsets in ends and hold the
+# number of chars in stream_sizes.
+#
+# The decode tables are expanded into one table indexed by
+# max_len bits, and every 8 byte big endian word of the data is
+# precomputed. Each step of the loop then reads the next max_len
+# bits of every lane with one word lookup and shift, looks up
+# the chars and code lengths of all lanes and advances all bit
+# cursors at once. Lanes that have decoded all their chars stop
+# advancing. Returns the decoded data as bytes.
+#
+# With few lanes the loop overhead dominates, so this only pays
+# off for many sub-streams, see NUMPY_MIN_LANES.
+#-------------------------------------------------------------------
+def decode_numpy_lanes(src_bytes, decode_tables, starts, ends, stream_sizes):
+    sink = METRICS_SINK
+    if sink != None:
+        start_time = time.perf_counter()
+
+    (lookup_bits, max_len, primary, secondary) = decode_tables
+    rest_bits = max_len - lookup_bits
+    windows = numpy.arange(1 << max_len)
+    entries = numpy.array(primary, dtype=numpy.int64)[windows >> rest_bits]
+    for (prefix, entry) in enumerate(primary):
+        if entry < 0:
+            (sub_bits, sub_table) = secondary[-entry - 1]
+            rest = windows[prefix << rest_bits : (prefix + 1) << rest_bits]
+            rest = (rest & ((1 << rest_bits) - 1)) >> (rest_bits - sub_bits)
+            entries[prefix << rest_bits : (prefix + 1) << rest_bits] =\
+                numpy.array(sub_table, dtype=numpy.int64)[rest]
+    char_table = (entries >> 8).astype(numpy.uint8)
+    len_table = (entries & 0xff).astype(numpy.uint64)
+    invalid_pos = numpy.uint64(1 << 40)
+    len_table[len_table == 0] = invalid_pos
+
+    num_bytes = len(src_bytes)
+    padded = numpy.zeros(num_bytes + 8, dtype=numpy.uint64)
+    padded[: num_bytes] = numpy.frombuffer(src_bytes, dtype=numpy.uint8)
+    words = numpy.zeros(num_bytes + 1, dtype=numpy.uint64)
+    for i in range(8):
+        words |= padded[i : i + num_bytes + 1] << numpy.uint64(56 - 8 * i)
+
+    num_lanes = len(stream_sizes)
+    num_steps = max(stream_sizes)
+    lane_sizes = numpy.array(stream_sizes)
+    bit_pos = numpy.array(starts, dtype=numpy.uint64) << numpy.uint64(3)
+    max_index = numpy.uint64(num_bytes)
+    window_shift = numpy.uint64(64 - max_len)
+    three = numpy.uint64(3)
+    seven = numpy.uint64(7)
+    dst = numpy.zeros((num_lanes, num_steps), dtype=numpy.uint8)
+
+    # An invalid code moves the lane past invalid_pos, which is
+    # checked once after the loop instead of in every step.
+    for step in range(num_steps):
+        index = numpy.minimum(bit_pos >> three, max_index)
+        window = (words[index] << (bit_pos & seven)) >> window_shift
+        dst[:, step] = char_table[window]
+        lengths = len_table[window]
+        if step >= stream_sizes[-1]:
+            lengths[lane_sizes <= step] = 0
+        bit_pos += lengths
+
+    if (bit_pos >= invalid_pos).any():
+        raise ValueError("Invalid code in encoded data.")
+    if (bit_pos > numpy.array(ends, dtype=numpy.uint64) << three).any():
+        raise ValueError("Encoded data ended before %d chars were decoded."
+                         % sum(stream_sizes))
+
+    dst_bytes = dst.tobytes()[: sum(stream_sizes)]
+    if sink != None:
+        emit_metrics(sink, 'decode', start_time, bytes_in=num_bytes,
+                     bytes_out=len(dst_bytes))
+    return dst_bytes
+
+
+#-------------------------------------------------------------------
+# class Encoder
+#
+# Incremental encoder, similar to zlib.compressobj(). Created
+# from the code lengths for all chars, the canonical codes are
+# used. Each call to feed() encodes the given data and returns
+# the complete bytes produced so far, with the bits of the last
+# partial byte kept until the next call. flush() returns the
+# last bits padded to a full byte. The number of chars fed is
+# kept in num_chars, since the decoder needs it.
+#-------------------------------------------------------------------
+class Encoder:
+    def __init__(self, len_table):
+        self.len_table = list(len_table)
+        self.code_table = gen_canonical_codes(self.len_table)
+        self.num_chars = 0
+        self.acc = 0
+        self.acc_bits = 0
+        self.flushed = False
+
+    def feed(self, data):
+        if self.flushed:
+            raise ValueError("Encoder has already been flushed.")
+        (dst_bytes, self.acc, self.acc_bits) = bitencode_chunk(data, self.code_table,
+                                                               self.len_table,
+                                                               self.acc, self.acc_bits)
+        self.num_chars += len(memoryview(data).cast('B'))
+        return dst_bytes
+
+    def flush(self):
+        if self.flushed:
+            return b''
+        self.flushed = True
+        return flush_bits(self.acc, self.acc_bits)
+
+
+#-------------------------------------------------------------------
+# class Decoder
+#
+# Incremental decoder, similar to zlib.decompressobj(). Created
+# from the code lengths and the number of chars encoded. Each
+# call to feed() returns the chars decoded from the data given so
+# far, with an incomplete last code kept until the next call.
+# When all chars have been decoded eof is set and any further
+# data is ignored. flush() raises ValueError if the data ended
+# before all chars were decoded.
+#-------------------------------------------------------------------
+class Decoder:
+    def __init__(self, len_table, num_chars):
+        self.len_table = list(len_table)
+        self.decode_tables = gen_decode_tables(gen_canonical_codes(self.len_table),
+                                               self.len_table)
+        self.chars_left = num_chars
+        self.eof = num_chars == 0
+        self.acc = 0
+        self.acc_bits = 0
+
+    def feed(self, data):
+        if self.eof:
+            return bytearray()
+        (dst_bytes, self.acc, self.acc_bits) = decode_chunk(data, self.decode_tables,
+                                                            self.chars_left,
+                                                            self.acc, self.acc_bits)
+        self.chars_left -= len(dst_bytes)
+        self.eof = self.chars_left == 0
+        return dst_bytes
+
+    def flush(self):
+        if not self.eof:
+            raise ValueError("Encoded data ended with %d chars left to decode."
+                             % self.chars_left)
+        return b''
 
 
 #-------------------------------------------------------------------
@@ -308,11 +1957,12 @@ def decode_string(src_string, code_db):
 def gen_bytestring(bitstring):
     num_bytes = int(len(bitstring) / 8)
     my_bytes = [bitstring[0+i:8+i] for i in range(0, len(bitstring), 8)]
-    print(my_bytes)
+    if VERBOSE:
+        print(my_bytes)
 
     my_bytestring = ""
     for ch in my_bytes:
-        my_bytestring += chr(int(ch, 2))
+        my_bytestring += chr(int(ch.ljust(8, '0'), 2))
 
     return my_bytestring
 
@@ -325,7 +1975,7 @@ def gen_bytestring(bitstring):
 def test_file():
     my_bytestring = load_file("prefix_tuple_tree.py")
     print("My file data:")
-    print(my_bytestring)
+    print(my_bytestring.tobytes())
     print("")
 
     my_list = gen_node_list(my_bytestring)
@@ -399,6 +2049,367 @@ def test_synthetic():
     print_prefix_codes(my_codes)
 
 
+#-------------------------------------------------------------------
+# test_canonical_codes()
+#
+# Test that the canonical codes built from synthetic data have
+# the same lengths as the tree codes and are prefix free.
+#-------------------------------------------------------------------
+def test_canonical_codes():
+    my_list = gen_random_node_list(256, int(1E8))
+    my_tree = gen_prefix_tree(my_list)
+    my_codes = extract_prefix_codes(my_tree)
+    (code_table, len_table) = extract_canonical_codes(my_tree)
+
+    for char in my_codes:
+        assert len(my_codes[char][1]) == len_table[char]
+
+    my_prefixes = canonical_to_prefix_codes(code_table, len_table, my_list)
+    my_strings = sorted(prefix for (weight, prefix) in my_prefixes.values())
+    for i in range(1, len(my_strings)):
+        assert not my_strings[i].startswith(my_strings[i - 1])
+
+    print("Canonical codes ok for %d chars." % len(my_prefixes))
+
+
+#-------------------------------------------------------------------
+# test_limited_codes()
+#
+# Test length limited codes on skewed synthetic data. Checks that
+# the package-merge and the clamped codes respect the limit and
+# are complete, and prints the cost compared to the unconstrained
+# codes.
+#-------------------------------------------------------------------
+def test_limited_codes(max_code_length = 12):
+    my_list = [(i, int(1E8 / (1.5 ** i)) + 1, 0, None, None) for i in range(256)]
+    my_tree = gen_prefix_tree(my_list)
+    (code_table, len_table) = extract_canonical_codes(my_tree)
+    (lim_code_table, lim_len_table) = extract_canonical_codes(my_tree,
+                                                              NUM_SYMBOLS,
+                                                              max_code_length)
+
+    assert max(lim_len_table) <= max_code_length
+    assert sum(2 ** -length for length in lim_len_table if length) == 1
+    assert get_code_cost(my_list, lim_len_table) >= get_code_cost(my_list, len_table)
+
+    # With a limit that is not reached the lengths must be optimal.
+    assert get_code_cost(my_list, gen_limited_code_lengths(my_list, max(len_table))) ==\
+        get_code_cost(my_list, len_table)
+
+    # Clamped lengths must respect the limit, be complete and cost
+    # no less than the optimal limited lengths.
+    clamp_len_table = gen_clamped_code_lengths(len_table, max_code_length)
+    assert max(clamp_len_table) <= max_code_length
+    assert sum(2 ** -length for length in clamp_len_table if length) == 1
+    assert get_code_cost(my_list, clamp_len_table) >= get_code_cost(my_list, lim_len_table)
+    assert gen_clamped_code_lengths(len_table, max(len_table)) == len_table
+
+    print("Unconstrained max code length %d, limited to %d." %\
+          (max(len_table), max(lim_len_table)))
+    print_prefix_codes(canonical_to_prefix_codes(lim_code_table, lim_len_table, my_list),
+                       canonical_to_prefix_codes(code_table, len_table, my_list))
+
+
+#-------------------------------------------------------------------
+# test_code_table_cache()
+#
+# Check that the code table cache reuses tables for similar
+# histograms, but not for a single char histogram unless the
+# char gets a one bit code, that a table built for a single
+# char histogram is not reused for other data, and that the
+# cache can be shared by threads.
+#-------------------------------------------------------------------
+def test_code_table_cache(filename):
+    my_bytestring = load_file(filename)
+    text_freqs = gen_histogram(my_bytestring)
+    zero_freqs = gen_histogram(bytes(1 << 20))
+    cache = CodeTableCache()
+
+    (code_table, len_table) = cache.get_codes(text_freqs)
+    assert cache.get_codes(text_freqs)[1] == len_table
+    assert cache.hits == 1
+
+    (code_table, len_table) = cache.get_codes(zero_freqs)
+    assert len_table[0] == 1
+    assert cache.get_codes(zero_freqs)[1][0] == 1
+
+    (code_table, len_table) = cache.get_codes(text_freqs)
+    assert get_code_cost(gen_histogram_node_list(text_freqs), len_table) <=\
+        get_entropy_bits(text_freqs) * 1.1
+
+    # Shared by threads, with constant evictions.
+    freq_lists = [gen_histogram(my_bytestring[i * 512 : i * 512 + 256])
+                  for i in range(16)]
+    shared_cache = CodeTableCache(max_entries=2)
+    errors = []
+
+    def get_shared_codes():
+        try:
+            for i in range(200):
+                shared_cache.get_codes(random.choice(freq_lists))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=get_shared_codes) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors[0]
+
+    print("Code table cache ok: %s." % cache.get_stats())
+
+
+#-------------------------------------------------------------------
+# test_inplace_code_lengths()
+#
+# Test that the in place code lengths have the same cost as the
+# tree based lengths, also for a skewed (Fibonacci) distribution
+# which gives a tree deeper than the default recursion limit.
+#-------------------------------------------------------------------
+def test_inplace_code_lengths():
+    for i in range(20):
+        freq_list = [random.randint(0, 1000) for j in range(NUM_SYMBOLS)]
+        nlist = gen_histogram_node_list(freq_list)
+        len_table = gen_histogram_code_lengths(freq_list)
+        assert get_code_cost(nlist, len_table) ==\
+            get_code_cost(nlist, get_code_lengths(gen_prefix_tree(nlist)))
+
+    fib = [1, 1]
+    while len(fib) < 1200:
+        fib.append(fib[-1] + fib[-2])
+    len_table = gen_histogram_code_lengths(fib)
+    assert max(len_table) == len(fib) - 1
+    assert len(extract_prefix_codes(gen_prefix_tree(gen_histogram_node_list(fib)))) ==\
+        len(fib)
+
+    print("In place code lengths ok, max length %d." % max(len_table))
+
+
+#-------------------------------------------------------------------
+# test_encoder_objects()
+#
+# Feed the given file to an Encoder and the result to a Decoder
+# in pieces of varying size and check that the data survives.
+#-------------------------------------------------------------------
+def test_encoder_objects(filename):
+    my_bytestring = bytes(load_file(filename))
+    (code_table, len_table) = gen_histogram_canonical_codes(gen_histogram(my_bytestring))
+
+    encoder = Encoder(len_table)
+    my_encoded = bytearray()
+    pos = 0
+    size = 1
+    while pos < len(my_bytestring):
+        my_encoded += encoder.feed(my_bytestring[pos : pos + size])
+        pos += size
+        size = size * 3 % 997 + 1
+    my_encoded += encoder.flush()
+    assert my_encoded == bitencode_bytes(my_bytestring, code_table, len_table)
+
+    decoder = Decoder(len_table, encoder.num_chars)
+    my_decoded = bytearray()
+    for pos in range(0, len(my_encoded), 5):
+        my_decoded += decoder.feed(my_encoded[pos : pos + 5])
+    decoder.flush()
+    assert decoder.eof and my_decoded == my_bytestring
+
+    # Chars without a code must not be silently dropped.
+    unused = len_table.index(0)
+    encoder = Encoder(len_table)
+    for data in (bytes([unused]), bytes([unused]) * NUMPY_MIN_SIZE):
+        try:
+            encoder.feed(data)
+            assert False, "Char without a code not detected."
+        except ValueError:
+            pass
+    assert encoder.num_chars == 0
+
+    print("Encoder and decoder objects ok for %d chars." % len(my_bytestring))
+
+
+#-------------------------------------------------------------------
+# test_code_length_header()
+#
+# Test that packed code lengths unpack to the same lengths, also
+# for 2^20 lengths, and that too long lengths are rejected. The
+# size of the headers written for real blocks is checked by
+# test_block_headers() in huffman.py.
+#-------------------------------------------------------------------
+def test_code_length_header():
+    for i in range(100):
+        len_table = [random.choice([0, 0, 0, 4, 5, 6, 7, 8, 20]) for j in range(NUM_SYMBOLS)]
+        packed = pack_code_lengths(len_table)
+        assert unpack_code_lengths(packed, NUM_SYMBOLS) == (len_table, len(packed))
+
+    len_table = [random.choice([0, 12, 17, 20, 24, 271]) for j in range(1 << 20)]
+    start_time = time.perf_counter()
+    packed = pack_code_lengths(len_table)
+    pack_time = time.perf_counter() - start_time
+    assert unpack_code_lengths(packed, len(len_table)) == (len_table, len(packed))
+    print("%d code lengths packed in %.2f s." % (len(len_table), pack_time))
+
+    try:
+        pack_code_lengths([1, 272])
+        assert False, "Too long code length not detected."
+    except ValueError:
+        pass
+
+
+#-------------------------------------------------------------------
+# test_decode()
+#
+# Test that data encoded with the prefix codes for a file is
+# decoded back to the original data, both with the default
+# lookup table size and with one small enough to force use of
+# the secondary tables. Also checks that very long codes from a
+# Fibonacci histogram decode with small tables.
+#-------------------------------------------------------------------
+def test_decode(filename):
+    my_bytestring = load_file(filename)
+    my_tree = gen_prefix_tree(gen_node_list(my_bytestring))
+    my_codes = extract_prefix_codes(my_tree)
+    my_encoded = gen_bytestring(bitencode_string(my_bytestring, my_codes))
+
+    (code_table, len_table) = get_code_tables(my_codes)
+    for lookup_bits in (LOOKUP_BITS, 4):
+        decode_tables = gen_decode_tables(code_table, len_table, lookup_bits)
+        my_decoded = decode_bytes(my_encoded.encode('latin-1'), decode_tables,
+                                  len(my_bytestring))
+        assert my_decoded == my_bytestring
+
+    fib_freqs = [1, 1]
+    while len(fib_freqs) < 64:
+        fib_freqs.append(fib_freqs[-1] + fib_freqs[-2])
+    (code_table, len_table) = gen_histogram_canonical_codes(fib_freqs[::-1])
+    decode_tables = gen_decode_tables(code_table, len_table)
+    (lookup_bits, max_len, primary, secondary) = decode_tables
+    assert max_len == 63
+    assert sum(len(sub_table) for (sub_bits, sub_table) in secondary) <=\
+        len(secondary) << SUB_LOOKUP_BITS
+    fib_bytes = bytes(range(64)) * 4
+    assert decode_bytes(bitencode_bytes(fib_bytes, code_table, len_table),
+                        decode_tables, len(fib_bytes)) == fib_bytes
+
+    print("Decoded %d chars ok." % len(my_bytestring))
+
+
+#-------------------------------------------------------------------
+# test_encoder_speed()
+#
+# Compare the bit string encoder (bitencode_string() and
+# gen_bytestring()) with the bit accumulator encoder
+# (bitencode_bytes()) on the given file. Reports throughput in
+# MB/s and peak memory allocated during encoding for each.
+#-------------------------------------------------------------------
+def test_encoder_speed(filename):
+    my_bytestring = load_file(filename)
+    my_tree = gen_prefix_tree(gen_node_list(my_bytestring))
+    my_codes = extract_prefix_codes(my_tree)
+    (code_table, len_table) = get_code_tables(my_codes)
+
+    def string_encoder():
+        return gen_bytestring(bitencode_string(my_bytestring, my_codes))
+
+    def bytes_encoder():
+        return bitencode_bytes(my_bytestring, code_table, len_table)
+
+    results = []
+    for (name, encoder) in (("bit string", string_encoder),
+                            ("bit accumulator", bytes_encoder)):
+        start = time.perf_counter()
+        my_encoded = encoder()
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        encoder()
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if isinstance(my_encoded, str):
+            my_encoded = my_encoded.encode('latin-1')
+        results.append(bytes(my_encoded))
+
+        mbps = len(my_bytestring) / (1024 * 1024) / elapsed
+        print("%-16s encoder: %8.2f MB/s, peak memory %10d bytes" %\
+              (name, mbps, peak))
+
+    assert results[0] == results[1]
+
+
+#-------------------------------------------------------------------
+# test_numpy_encoder()
+#
+# Compare the NumPy encoder with the pure Python encoder on the
+# given file, using the codes from extract_prefix_codes(). Checks
+# that the output is identical, also when continuing from a
+# partial byte, and reports the throughput of each.
+#-------------------------------------------------------------------
+def test_numpy_encoder(filename):
+    global numpy
+    if numpy is None:
+        print("NumPy not available, only the pure Python encoder is used.")
+        return
+
+    my_bytestring = load_file(filename)
+    my_codes = extract_prefix_codes(gen_prefix_tree(gen_node_list(my_bytestring)))
+    (code_table, len_table) = get_code_tables(my_codes)
+
+    results = []
+    numpy_module = numpy
+    for (name, module) in (("NumPy", numpy_module), ("Python", None)):
+        numpy = module
+        start_time = time.perf_counter()
+        enc_bytes = bitencode_bytes(my_bytestring, code_table, len_table)
+        elapsed = time.perf_counter() - start_time
+        results.append((enc_bytes, bitencode_chunk(my_bytestring, code_table,
+                                                   len_table, 5, 3)))
+        print("%s encoder: %.2f MB/s." %\
+              (name, len(my_bytestring) / (1024 * 1024) / max(elapsed, 1E-9)))
+    numpy = numpy_module
+
+    assert results[0] == results[1]
+
+
+#-------------------------------------------------------------------
+# test_streams()
+#
+# Encode the given file with encode_streams() using different
+# numbers of sub-streams and check that decode_streams() gets
+# the file back, with the NumPy lane decoder if available and
+# with the pure Python decoder.
+#-------------------------------------------------------------------
+def test_streams(filename):
+    global numpy
+    my_bytestring = bytes(load_file(filename))
+    (code_table, len_table) = gen_histogram_canonical_codes(
+        gen_histogram(my_bytestring), NUMPY_MAX_LANE_BITS)
+    decode_tables = gen_decode_tables(code_table, len_table)
+
+    numpy_module = numpy
+    for num_streams in (1, 4, 64, MAX_STREAMS):
+        enc_bytes = encode_streams(my_bytestring, code_table, len_table, num_streams)
+        for (name, module) in (("NumPy", numpy_module), ("Python", None)):
+            if name == "NumPy" and (module is None or num_streams < NUMPY_MIN_LANES):
+                continue
+            numpy = module
+            start_time = time.perf_counter()
+            dec_bytes = decode_streams(enc_bytes, decode_tables, len(my_bytestring),
+                                       num_streams)
+            elapsed = time.perf_counter() - start_time
+            numpy = numpy_module
+            assert dec_bytes == my_bytestring
+            print("%3d streams: %d bytes, %s decoder %.2f MB/s." %\
+                  (num_streams, len(enc_bytes), name,
+                   len(my_bytestring) / (1024 * 1024) / max(elapsed, 1E-9)))
+
+    try:
+        decode_streams(enc_bytes[: len(enc_bytes) // 2], decode_tables,
+                       len(my_bytestring), num_streams)
+        assert False, "Truncated streams not detected."
+    except ValueError:
+        pass
+
+
 #-------------------------------------------------------------------
 # test_bitshift()
 #